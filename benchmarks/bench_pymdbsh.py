@@ -0,0 +1,319 @@
+"""Benchmarks for pymdbsh.
+
+Measures SQL translation throughput, end-to-end query latency through
+execute_command, document serialization cost and redirect/pipe/export
+throughput. Runs against mongomock by default, against an existing server
+with --uri, or against a throwaway mongod started with --mongod.
+
+Results are written as JSON; pass --compare with an earlier results file
+to print the change for each benchmark.
+
+    python benchmarks/bench_pymdbsh.py
+    python benchmarks/bench_pymdbsh.py --mongod mongod --sizes 10000,1000000
+    python benchmarks/bench_pymdbsh.py --output new.json --compare old.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pymongo
+from bson import ObjectId, json_util
+
+import pymdbsh
+
+BENCH_DB = 'pymdbsh_bench'
+
+SQL_CORPUS = [
+    "SELECT * FROM users",
+    "SELECT name, age FROM users WHERE age > 30",
+    "SELECT name FROM users WHERE age >= 18 AND city = 'Oslo' ORDER BY name LIMIT 50",
+    "SELECT name, email FROM users WHERE city IN ('Oslo', 'Lima', 'Pune') AND active = true",
+    "SELECT * FROM users WHERE name LIKE 'user1%' OR age BETWEEN 20 AND 25 ORDER BY age DESC, name LIMIT 10 OFFSET 20",
+    "SELECT name FROM users WHERE NOT (age < 18) AND email IS NOT NULL",
+    "SELECT city, COUNT(*) FROM users GROUP BY city",
+    "SELECT city, AVG(age) AS avg_age, MAX(score) FROM users WHERE active = true "
+    "GROUP BY city HAVING COUNT(*) > 10 ORDER BY avg_age DESC",
+    "SELECT COUNT(*) FROM users WHERE age > 40",
+    "SELECT u.name, o.total FROM users u JOIN orders o ON u._id = o.user_id WHERE o.total > 100",
+    "SELECT u.name, o.total FROM users u LEFT JOIN orders o ON u._id = o.user_id "
+    "WHERE u.city = 'Oslo' ORDER BY u.name LIMIT 20",
+]
+
+# name -> (command, needs a real server)
+QUERIES = {
+    'find_filter': ("db.users.find({'age': {'$gt': 30}, 'city': 'Oslo'}, limit=100)", False),
+    'find_sort': ("db.users.find({'active': true}, sort=[('score', -1)], limit=100)", False),
+    'sql_select': ("SELECT name, age FROM users WHERE age > 30 AND city = 'Oslo' ORDER BY name LIMIT 100", False),
+    'aggregate_group': ("db.users.aggregate([{'$match': {'active': true}}, "
+                        "{'$group': {'_id': '$city', 'n': {'$sum': 1}, 'avg': {'$avg': '$age'}}}])", False),
+    'sql_group_by': ("SELECT city, COUNT(*), AVG(age) FROM users WHERE active = true GROUP BY city", False),
+    # mongomock has no pipeline $lookup
+    'sql_join': ("SELECT u.name, o.total FROM users u JOIN orders o ON u._id = o.user_id "
+                 "WHERE o.total > 900 LIMIT 100", True),
+}
+
+CITIES = ('Oslo', 'Lima', 'Pune', 'Kyiv', 'Accra', 'Quito', 'Hanoi')
+EPOCH = datetime.datetime(2024, 1, 1)
+
+
+def make_user(i):
+    return {
+        '_id': i,
+        'name': f'user{i}',
+        'email': f'user{i}@example.com' if i % 5 else None,
+        'age': i % 80,
+        'city': CITIES[i % len(CITIES)],
+        'active': i % 3 != 0,
+        'score': i * 0.5,
+        'created': EPOCH + datetime.timedelta(seconds=i),
+        'ref': ObjectId(),
+        'tags': ['a', 'b', 'c'][:i % 4],
+        'address': {'street': f'{i} Main St', 'zip': f'{i % 99999:05d}'},
+    }
+
+
+def load(coll, count, factory, chunk=10000):
+    coll.drop()
+    for start in range(0, count, chunk):
+        coll.insert_many([factory(i) for i in range(start, min(start + chunk, count))], ordered=False)
+
+
+def timings(fn, number=1, repeat=5):
+    """Run fn `number` times per round; return the per-call seconds of each round."""
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - started) / number)
+    return rounds
+
+
+def summarize(rounds, items=1, unit='ops'):
+    best = min(rounds)
+    return {
+        'best_ms': round(best * 1000, 4),
+        'median_ms': round(statistics.median(rounds) * 1000, 4),
+        'rate': round(items / best, 1) if best > 0 else None,
+        'unit': f'{unit}/s',
+        'rounds': len(rounds),
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def ephemeral_mongod(binary):
+    """Start a mongod on a temporary dbpath and free port; remove it afterwards."""
+    dbpath = tempfile.mkdtemp(prefix='pymdbsh-bench-')
+    port = free_port()
+    proc = subprocess.Popen([binary, '--dbpath', dbpath, '--port', str(port), '--bind_ip', '127.0.0.1'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = pymongo.MongoClient('127.0.0.1', port, serverSelectionTimeoutMS=30000)
+    try:
+        client.admin.command('ping')
+        yield client
+    finally:
+        client.close()
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(dbpath, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def open_backend(args):
+    """Yield (client, backend name) for the requested server."""
+    if args.mongod:
+        with ephemeral_mongod(args.mongod) as client:
+            yield client, 'mongod'
+    elif args.uri:
+        client = pymongo.MongoClient(args.uri)
+        try:
+            yield client, 'server'
+        finally:
+            client.drop_database(BENCH_DB)
+            client.close()
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is not installed: pip install mongomock, or pass --uri/--mongod")
+        yield mongomock.MongoClient(), 'mongomock'
+
+
+def make_cli(client):
+    cli = pymdbsh.MongoCLI(os.devnull)  # no connections configured
+    cli.client = client
+    cli.db = client[BENCH_DB]
+    cli.current_conn = 'bench'
+    return cli
+
+
+def bench_translation(results, repeat):
+    n = len(SQL_CORPUS)
+    results['translate/cold'] = summarize(
+        timings(lambda: [pymdbsh.sql_to_mongo(q) for q in SQL_CORPUS], repeat=repeat), n, 'statements')
+    cache = pymdbsh.PlanCache()
+    for q in SQL_CORPUS:
+        pymdbsh.sql_to_mongo(q, cache)
+    results['translate/plan_cache'] = summarize(
+        timings(lambda: [pymdbsh.sql_to_mongo(q, cache) for q in SQL_CORPUS], number=10, repeat=repeat),
+        n, 'statements')
+
+
+def bench_queries(results, cli, backend, repeat):
+    for name, (command, needs_server) in QUERIES.items():
+        if needs_server and backend == 'mongomock':
+            results[f'query/{name}'] = {'skipped': 'needs --uri or --mongod'}
+            continue
+        rounds = timings(lambda: cli.execute_command(command, out=io.StringIO()), number=5, repeat=repeat)
+        results[f'query/{name}'] = summarize(rounds, 1, 'queries')
+
+
+def bench_serializers(results, repeat, count=2000):
+    docs = [make_user(i) for i in range(count)]
+    encoders = {
+        'json_util.dumps': lambda doc: json_util.dumps(doc),
+        'json_util': pymdbsh.make_encoder('json_util'),
+        'json_util/canonical': pymdbsh.make_encoder('json_util', 'canonical'),
+    }
+    try:
+        import orjson  # noqa: F401
+    except ImportError:
+        results['serialize/orjson'] = {'skipped': 'orjson is not installed'}
+    else:
+        encoders['orjson'] = pymdbsh.make_encoder('orjson')
+        encoders['orjson/canonical'] = pymdbsh.make_encoder('orjson', 'canonical')
+    for name, encode in encoders.items():
+        rounds = timings(lambda: [encode(doc) for doc in docs], repeat=repeat)
+        results[f'serialize/{name}'] = summarize(rounds, count, 'docs')
+
+
+def bench_export(results, cli, backend, sizes, workdir):
+    for size in sizes:
+        collection = f'export{size}'
+        load(cli.db[collection], size, make_user)
+        cases = {
+            'redirect_ndjson': f"db.{collection}.find({{}}) > {workdir}/out.ndjson",
+            'redirect_csv': f"db.{collection}.find({{}}) > {workdir}/out.csv",
+            'pipe_wc': f"db.{collection}.find({{}}) | wc -l > {workdir}/count.txt",
+            'export_ndjson_gz': f"export {collection} TO {workdir}/export.ndjson.gz",
+        }
+        # mongomock cannot return RawBSONDocuments
+        if backend != 'mongomock':
+            cases['redirect_bson'] = f"db.{collection}.find({{}}) > {workdir}/out.bson"
+        repeat = 1 if size >= 1000000 else 3
+        saved = cli.settings['format']
+        cli.settings['format'] = 'ndjson'
+        try:
+            for name, command in cases.items():
+                with quiet():
+                    rounds = timings(lambda: cli.run_command(command), repeat=repeat)
+                results[f'export/{name}/{size}'] = summarize(rounds, size, 'docs')
+        finally:
+            cli.settings['format'] = saved
+            cli.db[collection].drop()
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as fh:
+        baseline = json.load(fh)['results']
+    print(f"\n{'benchmark':<40} {'before ms':>12} {'after ms':>12} {'change':>9}")
+    for name, new in results.items():
+        old = baseline.get(name)
+        if not old or 'best_ms' not in old or 'best_ms' not in new:
+            continue
+        change = (new['best_ms'] - old['best_ms']) / old['best_ms'] * 100 if old['best_ms'] else 0.0
+        print(f"{name:<40} {old['best_ms']:>12.3f} {new['best_ms']:>12.3f} {change:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pymdbsh benchmarks")
+    server = parser.add_mutually_exclusive_group()
+    server.add_argument('--uri', help="benchmark against this server (uses database pymdbsh_bench)")
+    server.add_argument('--mongod', metavar='BINARY', help="start a throwaway mongod from this binary")
+    parser.add_argument('--docs', type=int, default=10000, help="documents in the query collection (default 10000)")
+    parser.add_argument('--sizes', default=None,
+                        help="comma separated export sizes (default 10000, plus 1000000 on a real server)")
+    parser.add_argument('--repeat', type=int, default=5, help="rounds per benchmark; the best is reported")
+    parser.add_argument('--only', help="comma separated groups: translate,query,serialize,export")
+    parser.add_argument('--output', default='bench_results.json', help="results file (default bench_results.json)")
+    parser.add_argument('--compare', metavar='FILE', help="print the change against an earlier results file")
+    args = parser.parse_args()
+    groups = set(args.only.split(',')) if args.only else {'translate', 'query', 'serialize', 'export'}
+
+    results = {}
+    with open_backend(args) as (client, backend):
+        sizes = [int(s) for s in args.sizes.split(',')] if args.sizes else (
+            [10000] if backend == 'mongomock' else [10000, 1000000])
+        cli = make_cli(client)
+        workdir = tempfile.mkdtemp(prefix='pymdbsh-bench-out-')
+        try:
+            if 'translate' in groups:
+                bench_translation(results, args.repeat)
+            if 'query' in groups:
+                load(cli.db.users, args.docs, make_user)
+                load(cli.db.orders, args.docs, lambda i: {'_id': i, 'user_id': i % max(args.docs // 4, 1),
+                                                          'total': i % 1000})
+                cli.db.users.create_index('age')
+                bench_queries(results, cli, backend, args.repeat)
+            if 'serialize' in groups:
+                bench_serializers(results, args.repeat)
+            if 'export' in groups:
+                bench_export(results, cli, backend, sizes, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            if backend == 'mongomock':
+                client.drop_database(BENCH_DB)
+
+    for name, r in results.items():
+        if 'skipped' in r:
+            print(f"{name:<40} skipped: {r['skipped']}")
+        else:
+            print(f"{name:<40} {r['best_ms']:>12.3f} ms {r['rate']:>14,.0f} {r['unit']}")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'backend': backend,
+            'python': platform.python_version(),
+            'pymongo': pymongo.version,
+            'platform': platform.platform(),
+            'docs': args.docs,
+            'sizes': sizes,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
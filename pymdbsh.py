@@ -2,24 +2,1427 @@ import sys
 import os
 import pymongo
 import configparser
-import subprocess
-import shlex
+import io
 import json
 import re
-from prompt_toolkit import PromptSession
-from prompt_toolkit.history import FileHistory
+import ast
+import copy
+import contextlib
+from collections import OrderedDict, namedtuple
+import gzip
+import csv
+import shutil
+import time
+import itertools
+import functools
+import threading
+import base64
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import bson
 from bson import json_util
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+# Tunable session settings; overridable from the [settings] config section
+# or at runtime with `setopt <name> = <value>`.
+DEFAULT_SETTINGS = {
+    'batch_size': 1000,   # documents per server round trip (cursor batches, import batches)
+    'format': 'json',     # json/pretty | compact | ndjson | bson | table | csv | tsv | parquet | arrow
+    'serializer': 'auto', # auto (orjson when installed) | orjson | json_util
+    'json_mode': 'relaxed',  # relaxed | canonical Extended JSON
+    'workers': 4,         # parallel scans for export, batches in flight for import
+    'plan_cache_size': 256,  # translated SQL plans kept in the LRU cache (0 disables)
+    'schema_sample_size': 100,  # documents sampled to learn a collection's fields
+    'schema_ttl': 300,    # seconds before sampled fields are re-sampled (0 keeps them)
+    'optimize': True,     # rewrite generated pipelines (JOIN pushdown needs MongoDB 5.0+)
+    'show_plan': False,   # print generated pipelines before and after optimization
+    'timing': False,      # report client-side phase timings after each command
+    'result_cache': False,   # replay repeated find/aggregate/SELECT results from memory
+    'result_cache_ttl': 60,  # seconds a cached result stays valid (0 keeps it until invalidated)
+    'result_cache_bytes': 64 * 1024 * 1024,  # BSON bytes the result cache may hold
+    'result_cache_watch': False,  # also invalidate from change streams (replica sets only)
+    'page_size': 20,      # documents per page in the interactive shell (0 prints everything)
+}
+OUTPUT_FORMATS = ('json', 'pretty', 'compact', 'ndjson', 'bson', 'table', 'csv', 'tsv', 'parquet', 'arrow')
+# Formats whose writers lay documents out in columns
+TABULAR_FORMATS = ('table', 'csv', 'tsv', 'parquet', 'arrow')
+# Output formats picked by the extension of a `>` redirect target
+REDIRECT_FORMATS = {'.bson': 'bson', '.csv': 'csv', '.tsv': 'tsv', '.parquet': 'parquet', '.arrow': 'arrow'}
+# Settings restricted to a fixed set of values
+SETTING_CHOICES = {
+    'format': OUTPUT_FORMATS,
+    'serializer': ('auto', 'orjson', 'json_util'),
+    'json_mode': ('relaxed', 'canonical'),
+}
+
+def coerce_setting(name, value):
+    """Convert a textual setting value to the type of its default."""
+    default = DEFAULT_SETTINGS[name]
+    if isinstance(default, bool):
+        return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        value = int(value)
+        if value < 0:
+            raise ValueError(f"{name} must be >= 0")
+        return value
+    value = str(value).strip()
+    if name in SETTING_CHOICES:
+        value = value.lower()
+        if value not in SETTING_CHOICES[name]:
+            raise ValueError(f"{name} must be one of: {', '.join(SETTING_CHOICES[name])}")
+    return value
+
+# Extended JSON flavours selectable with the json_mode setting
+JSON_MODES = {
+    'relaxed': json_util.RELAXED_JSON_OPTIONS,
+    'canonical': json_util.CANONICAL_JSON_OPTIONS,
+}
+
+def json_util_encoder(mode='relaxed'):
+    """Encoder built on bson.json_util: pure Python, exact for every BSON type."""
+    options = JSON_MODES[mode]
+
+    def encode(doc, indent=None):
+        return json_util.dumps(doc, json_options=options, indent=indent, ensure_ascii=False)
+    return encode
+
+def encode_relaxed_datetime(value):
+    offset = value.utcoffset()
+    if not offset and value.year >= 1970:
+        millis = value.microsecond // 1000
+        return {"$date": f"{value:%Y-%m-%dT%H:%M:%S}{f'.{millis:03d}' if millis else ''}Z"}
+    return json_util.default(value, json_util.RELAXED_JSON_OPTIONS)
+
+def encode_binary(value):
+    subtype = getattr(value, 'subtype', 0)
+    return {"$binary": {"base64": base64.b64encode(value).decode(), "subType": f"{subtype:02x}"}}
+
+# Relaxed Extended JSON for the BSON types found in most documents, looked
+# up by exact type; anything else goes through json_util.default
+FAST_EJSON_TYPES = {
+    ObjectId: lambda value: {"$oid": str(value)},
+    datetime.datetime: encode_relaxed_datetime,
+    Decimal128: lambda value: {"$numberDecimal": str(value)},
+    Binary: encode_binary,
+    bytes: encode_binary,
+}
+
+def has_nonfinite(value):
+    if isinstance(value, float):
+        return value != value or value in (float('inf'), float('-inf'))
+    if isinstance(value, dict):
+        return any(has_nonfinite(v) for v in value.values())
+    if isinstance(value, list):
+        return any(has_nonfinite(v) for v in value)
+    return False
+
+def orjson_encoder(mode='relaxed'):
+    """Encoder built on orjson, or None when orjson is missing or mode is canonical.
+
+    Canonical mode wraps every int and float, which orjson writes natively,
+    so it is left to json_util. Documents orjson rejects, or whose nulls
+    may hide NaN/Infinity, are re-encoded with json_util.
+    """
+    if mode != 'relaxed':
+        return None
+    try:
+        import orjson
+    except ImportError:
+        return None
+    fallback = json_util_encoder(mode)
+    options = JSON_MODES[mode]
+
+    def default(value):
+        convert = FAST_EJSON_TYPES.get(type(value))
+        if convert is not None:
+            return convert(value)
+        try:
+            return json_util.default(value, options)
+        except TypeError:
+            # Plain subclasses of built-ins, e.g. SON
+            for base in (dict, list, str, int):
+                if isinstance(value, base):
+                    return base(value)
+            raise
+
+    def encode(doc, indent=None):
+        # Subclasses pass through too: bson.Code is a str that must become $code
+        option = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+                  | (orjson.OPT_INDENT_2 if indent else 0))
+        try:
+            data = orjson.dumps(doc, default=default, option=option)
+        except TypeError:
+            return fallback(doc, indent)
+        # orjson writes NaN and Infinity as null; json_util keeps them as $numberDouble
+        if b'null' in data and has_nonfinite(doc):
+            return fallback(doc, indent)
+        return data.decode('utf-8')
+    return encode
+
+SERIALIZERS = {
+    'orjson': orjson_encoder,
+    'json_util': json_util_encoder,
+}
+
+def make_encoder(serializer='auto', mode='relaxed'):
+    """Return encode(doc, indent=None) -> str for the serializer and json_mode settings.
+
+    orjson is used when requested (or for auto) and able to handle the mode;
+    otherwise json_util.
+    """
+    encode = SERIALIZERS['orjson'](mode) if serializer in ('auto', 'orjson') else None
+    return encode or json_util_encoder(mode)
+
+def write_json_array(docs, out, batch_size, encode=None):
+    """Write docs as an indented JSON array, one element at a time.
+
+    With the json_util encoder the output is byte-for-byte what
+    json_util.dumps(list(docs), indent=2) would produce, but only one
+    document is held in memory at a time.
+    """
+    encode = encode or json_util_encoder()
+    count = 0
+    out.write('[')
+    for doc in docs:
+        out.write('\n  ' if count == 0 else ',\n  ')
+        out.write(encode(doc, 2).replace('\n', '\n  '))
+        count += 1
+        # Show the first row immediately, then flush once per batch
+        if count == 1 or (batch_size and count % batch_size == 0):
+            out.flush()
+    out.write('\n]\n' if count else ']\n')
+    out.flush()
+    return count
+
+def write_json_compact(docs, out, batch_size, encode=None):
+    """Write docs as a JSON array on a single line."""
+    encode = encode or json_util_encoder()
+    count = 0
+    out.write('[')
+    for doc in docs:
+        if count:
+            out.write(', ')
+        out.write(encode(doc))
+        count += 1
+        if count == 1 or (batch_size and count % batch_size == 0):
+            out.flush()
+    out.write(']\n')
+    out.flush()
+    return count
+
+def write_ndjson(docs, out, batch_size, encode=None):
+    """Write docs as newline-delimited JSON, one compact document per line."""
+    encode = encode or json_util_encoder()
+    count = 0
+    for doc in docs:
+        out.write(encode(doc))
+        out.write('\n')
+        count += 1
+        if count == 1 or (batch_size and count % batch_size == 0):
+            out.flush()
+    out.flush()
+    return count
+
+def write_bson(docs, out, batch_size, encode=None):
+    """Write docs as concatenated BSON documents, the layout of mongodump's .bson files.
+
+    Goes to out's underlying binary buffer. RawBSONDocuments are written
+    as the bytes the server sent, without decoding or re-encoding them.
+    """
+    out.flush()
+    raw = out.buffer
+    count = 0
+    for doc in docs:
+        raw.write(doc.raw if isinstance(doc, RawBSONDocument) else bson.encode(doc))
+        count += 1
+        if count == 1 or (batch_size and count % batch_size == 0):
+            raw.flush()
+    raw.flush()
+    return count
+
+def raw_collection(coll):
+    """The same collection, returning undecoded RawBSONDocuments from cursors."""
+    return coll.with_options(codec_options=coll.codec_options.with_options(document_class=RawBSONDocument))
+
+def is_bson_path(path):
+    """True for .bson files, optionally .gz/.zst compressed."""
+    name = path[:-3] if path.endswith('.gz') else path[:-4] if path.endswith('.zst') else path
+    return name.lower().endswith('.bson')
+
+def result_columns(method, args):
+    """Column names implied by a find projection or a pipeline's final $project/$group.
+
+    Returns None when the columns can only be discovered from the documents
+    (no projection, an exclusion projection, or other trailing stages).
+    """
+    projection = None
+    if method == 'find':
+        projection = args[1] if len(args) > 1 else None
+    elif method == 'aggregate':
+        for stage in reversed(args[0] if args else []):
+            if '$project' in stage:
+                projection = stage['$project']
+                break
+            if '$group' in stage:
+                return ['_id'] + [k for k in stage['$group'] if k != '_id']
+            if '$count' in stage:
+                return [stage['$count']]
+            if not any(k in stage for k in ('$sort', '$skip', '$limit', '$match')):
+                return None
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, 1)
+    if not projection or any(v in (0, False) for k, v in projection.items() if k != '_id'):
+        return None
+    columns = [k for k in projection if k != '_id']
+    return columns if projection.get('_id', 1) in (0, False) else ['_id'] + columns
+
+def discover_columns(docs):
+    """Union of the top-level field names of docs, in first-seen order."""
+    return list(dict.fromkeys(k for doc in docs for k in doc))
+
+def get_path(doc, path):
+    """Value at a dotted path of doc, or None."""
+    if path in doc:
+        return doc[path]
+    value = doc
+    for part in path.split('.'):
+        if not hasattr(value, 'get'):
+            return None
+        value = value.get(part)
+    return value
+
+def cell_text(value, encode):
+    """Text of one table/CSV cell; documents and arrays become compact JSON."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (str, int, float, ObjectId, Decimal128)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return encode(value)
+
+# Longest cell shown by the table format before it is cut off
+MAX_CELL_WIDTH = 40
+
+def write_table(docs, out, batch_size, encode=None, columns=None):
+    """Write docs as an aligned text table; column widths come from the first batch."""
+    encode = encode or json_util_encoder()
+    widths = None
+    count = 0
+
+    def line(cells):
+        return ' | '.join((c if len(c) <= w else c[:w - 1] + '~').ljust(w) for c, w in zip(cells, widths)).rstrip() + '\n'
+
+    for batch in iter_batches(docs, batch_size or 1000):
+        columns = columns or discover_columns(batch)
+        rows = [[cell_text(get_path(doc, c), encode).replace('\n', ' ') for c in columns] for doc in batch]
+        if widths is None:
+            widths = [min(max([len(c)] + [len(row[i]) for row in rows]), MAX_CELL_WIDTH)
+                      for i, c in enumerate(columns)]
+            out.write(line(columns))
+            out.write('-+-'.join('-' * w for w in widths) + '\n')
+        out.writelines(line(row) for row in rows)
+        count += len(rows)
+        out.flush()
+    out.write(f"({count} rows)\n")
+    out.flush()
+    return count
+
+def write_delimited(docs, out, batch_size, encode=None, columns=None, delimiter=','):
+    """Write docs as CSV (or TSV) with a header row, one batch of rows at a time."""
+    encode = encode or json_util_encoder()
+    writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+    count = 0
+    for batch in iter_batches(docs, batch_size or 1000):
+        if count == 0:
+            columns = columns or discover_columns(batch)
+            writer.writerow(columns)
+        writer.writerows([cell_text(get_path(doc, c), encode) for c in columns] for doc in batch)
+        count += len(batch)
+        out.flush()
+    out.flush()
+    return count
+
+def write_csv(docs, out, batch_size, encode=None, columns=None):
+    return write_delimited(docs, out, batch_size, encode, columns)
+
+def write_tsv(docs, out, batch_size, encode=None, columns=None):
+    return write_delimited(docs, out, batch_size, encode, columns, delimiter='\t')
+
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError("parquet and arrow output require pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+def arrow_value(value, encode):
+    """Python value pyarrow can infer a type for."""
+    if value is None or isinstance(value, (str, bool, int, float, datetime.datetime)):
+        return value
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, bytes):
+        return bytes(value)
+    return encode(value)
+
+# Documents read ahead to find a non-null value, and so a type, for every arrow column
+ARROW_TYPE_SAMPLE = 10000
+
+def arrow_batches(docs, batch_size, encode, columns):
+    """Yield (schema, RecordBatch) per batch of docs, converting column by column.
+
+    The first batch fixes the columns. Their types are fixed by the first
+    documents, read ahead (up to ARROW_TYPE_SAMPLE) until every column has
+    a non-null value. Columns whose values mix types, or are null in all of
+    those documents, are stored as strings.
+    """
+    pa = import_pyarrow()
+    schema = None
+
+    def convert(batch):
+        nonlocal schema
+        arrays = []
+        for i, name in enumerate(columns):
+            values = [arrow_value(get_path(doc, name), encode) for doc in batch]
+            target = schema.field(i).type if schema is not None else None
+            try:
+                array = pa.array(values, type=target)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+                if target is not None and not pa.types.is_string(target):
+                    raise ValueError(f"column {name} no longer fits type {target}; project or cast it in the query")
+                array = pa.array([v if v is None or isinstance(v, str) else str(v) for v in values], type=pa.string())
+            if target is None and pa.types.is_null(array.type):
+                array = array.cast(pa.string())
+            arrays.append(array)
+        if schema is None:
+            schema = pa.schema([pa.field(name, array.type) for name, array in zip(columns, arrays)])
+        return schema, pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    held = []  # documents read ahead while some column has only had nulls
+    typed = set()
+    for batch in iter_batches(docs, batch_size or 1000):
+        columns = columns or discover_columns(batch)
+        if schema is None:
+            held.extend(batch)
+            typed.update(c for c in columns if c not in typed and any(get_path(doc, c) is not None for doc in batch))
+            if len(typed) < len(columns) and len(held) < ARROW_TYPE_SAMPLE:
+                continue
+            batch, held = held, []
+        yield convert(batch)
+    if held:
+        yield convert(held)
+
+def write_parquet(docs, out, batch_size, encode=None, columns=None):
+    """Write docs to out's binary buffer as Parquet, one row group per batch."""
+    import_pyarrow()
+    import pyarrow
+    import pyarrow.parquet as pq
+    encode = encode or json_util_encoder()
+    out.flush()
+    writer = None
+    count = 0
+    try:
+        for schema, batch in arrow_batches(docs, batch_size, encode, columns):
+            if writer is None:
+                writer = pq.ParquetWriter(out.buffer, schema)
+            writer.write_batch(batch)
+            count += batch.num_rows
+        if writer is None:
+            writer = pq.ParquetWriter(out.buffer, pyarrow.schema([]))
+    finally:
+        # Also on errors, so the writer isn't left to close (and write) from __del__
+        if writer is not None:
+            writer.close()
+    out.buffer.flush()
+    return count
+
+def write_arrow(docs, out, batch_size, encode=None, columns=None):
+    """Write docs to out's binary buffer as an Arrow IPC stream of record batches."""
+    pa = import_pyarrow()
+    encode = encode or json_util_encoder()
+    out.flush()
+    writer = None
+    count = 0
+    try:
+        for schema, batch in arrow_batches(docs, batch_size, encode, columns):
+            if writer is None:
+                writer = pa.ipc.new_stream(out.buffer, schema)
+            writer.write_batch(batch)
+            count += batch.num_rows
+            out.buffer.flush()
+        if writer is None:
+            writer = pa.ipc.new_stream(out.buffer, pa.schema([]))
+    finally:
+        if writer is not None:
+            writer.close()
+    out.buffer.flush()
+    return count
+
+RESULT_WRITERS = {
+    'json': write_json_array,
+    'pretty': write_json_array,
+    'compact': write_json_compact,
+    'ndjson': write_ndjson,
+    'bson': write_bson,
+    'table': write_table,
+    'csv': write_csv,
+    'tsv': write_tsv,
+    'parquet': write_parquet,
+    'arrow': write_arrow,
+}
+
+def open_compressed(path, mode='wb', name=None):
+    """Open a binary file, (de)compressing by the extension of name (defaults to path).
+
+    Supports .gz, and .zst when the zstandard package is installed.
+    """
+    name = name or path
+    if name.endswith('.gz'):
+        return gzip.open(path, mode)
+    if name.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("Reading or writing .zst files requires the 'zstandard' package.")
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+    return open(path, mode)
+
+def iter_ndjson(fh):
+    """Yield one document per non-blank line of Extended JSON."""
+    for line in fh:
+        if line.strip():
+            yield json_util.loads(line)
+
+def iter_json(fh, chunk_size=1 << 16):
+    """Yield documents from a JSON array (or concatenated JSON objects) without loading the whole file."""
+    decoder = json.JSONDecoder(object_pairs_hook=json_util.object_pairs_hook)
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        # Skip whitespace and array punctuation between documents
+        while pos < len(buf) and buf[pos] in ' \t\r\n[,]':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                return
+            buf, pos = fh.read(chunk_size), 0
+            eof = not buf
+            continue
+        try:
+            doc, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = fh.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield doc
+        pos = end
+
+# Plain JSON-style numbers only: no nan/inf, underscores, padding or leading zeros (zip codes)
+CSV_NUMBER_RE = re.compile(r"-?(0|[1-9]\d*)(?P<fraction>\.\d+)?(?P<exponent>[eE][-+]?\d+)?")
+
+def parse_csv_value(value):
+    """Convert numeric and boolean CSV cells; everything else stays a string."""
+    lowered = value.lower()
+    if lowered in ('true', 'false'):
+        return lowered == 'true'
+    m = CSV_NUMBER_RE.fullmatch(value)
+    if m is None:
+        return value
+    return float(value) if m.group('fraction') or m.group('exponent') else int(value)
+
+def iter_csv(fh):
+    """Yield one document per CSV row, using the header row as field names."""
+    for row in csv.DictReader(fh):
+        yield {k: parse_csv_value(v) for k, v in row.items() if k is not None}
+
+def iter_bson(fh):
+    """Yield RawBSONDocuments from concatenated BSON (mongodump .bson files)."""
+    raw = getattr(fh, 'buffer', fh)
+    while True:
+        header = raw.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated BSON document")
+        size = int.from_bytes(header, 'little')
+        body = raw.read(size - 4)
+        if len(body) < size - 4:
+            raise ValueError("Truncated BSON document")
+        yield RawBSONDocument(header + body)
+
+DOCUMENT_READERS = {
+    '.ndjson': iter_ndjson,
+    '.jsonl': iter_ndjson,
+    '.json': iter_json,
+    '.csv': iter_csv,
+    '.bson': iter_bson,
+}
+
+def iter_batches(docs, size):
+    """Group an iterable of documents into lists of at most size documents."""
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def default_rows(docs, row):
+    """Yield docs, or just row when there are none."""
+    empty = True
+    for doc in docs:
+        empty = False
+        yield doc
+    if empty:
+        yield row
+
+def compute_split_points(coll, filter_doc, parts, oversample=20):
+    """Pick up to parts-1 _id values that divide the matching documents evenly.
+
+    Split points come from a sorted $sample of _ids. Range filters on _id
+    only match values of the same BSON type, so collections with mixed
+    _id types are not split.
+    """
+    if parts < 2:
+        return []
+    pipeline = []
+    if filter_doc:
+        pipeline.append({"$match": filter_doc})
+    pipeline += [
+        {"$sample": {"size": parts * oversample}},
+        {"$project": {"_id": 1}},
+        {"$sort": {"_id": 1}},
+    ]
+    ids = [doc['_id'] for doc in coll.aggregate(pipeline)]
+    if len(ids) < parts or len({type(i) for i in ids}) > 1:
+        return []
+    points = []
+    for i in range(1, parts):
+        point = ids[i * len(ids) // parts]
+        if not points or point != points[-1]:
+            points.append(point)
+    return points
+
+def id_range_filters(filter_doc, split_points):
+    """Build one filter per _id range [None, p1), [p1, p2), ... [pn, None)."""
+    bounds = [None] + list(split_points) + [None]
+    filters = []
+    for lo, hi in zip(bounds, bounds[1:]):
+        id_cond = {}
+        if lo is not None:
+            id_cond['$gte'] = lo
+        if hi is not None:
+            id_cond['$lt'] = hi
+        if not id_cond:
+            filters.append(filter_doc)
+        elif filter_doc:
+            filters.append({"$and": [filter_doc, {"_id": id_cond}]})
+        else:
+            filters.append({"_id": id_cond})
+    return filters
+
+JSON_LITERALS = {'true': True, 'false': False, 'null': None}
+
+class _JSONLiterals(ast.NodeTransformer):
+    """Let shell arguments use JSON's true/false/null alongside Python literals."""
+    def visit_Name(self, node):
+        if node.id in JSON_LITERALS:
+            return ast.copy_location(ast.Constant(JSON_LITERALS[node.id]), node)
+        return node
+
+def parse_call_args(argstr):
+    """Parse `filter, update, upsert=True` into ([filter, update], {'upsert': True}).
+
+    Only literals are accepted; anything else raises ValueError or SyntaxError.
+    Plain JSON arguments take the json.loads fast path; the AST parse is only
+    needed for keyword arguments and Python literals.
+    """
+    try:
+        return json.loads(f"[{argstr}]"), {}
+    except ValueError:
+        pass
+    call = _JSONLiterals().visit(ast.parse(f"f({argstr})", mode='eval')).body
+    args = [ast.literal_eval(arg) for arg in call.args]
+    kwargs = {}
+    for kw in call.keywords:
+        if kw.arg is None:
+            raise ValueError("** arguments are not supported")
+        kwargs[kw.arg] = ast.literal_eval(kw.value)
+    return args, kwargs
+
+# Mongo shell style bulk_write operations -> pymongo operation classes
+BULK_OPERATIONS = {
+    'insertOne': pymongo.InsertOne,
+    'updateOne': pymongo.UpdateOne,
+    'updateMany': pymongo.UpdateMany,
+    'replaceOne': pymongo.ReplaceOne,
+    'deleteOne': pymongo.DeleteOne,
+    'deleteMany': pymongo.DeleteMany,
+}
+BULK_OPTION_NAMES = {'arrayFilters': 'array_filters'}
+
+def to_bulk_operation(op):
+    """Convert {"updateOne": {"filter": ..., "update": ..., "upsert": true}} to pymongo.UpdateOne(...)."""
+    if not isinstance(op, dict) or len(op) != 1:
+        raise ValueError(f"Invalid bulk_write operation: {op}")
+    name, spec = next(iter(op.items()))
+    if name not in BULK_OPERATIONS:
+        raise ValueError(f"Unsupported bulk_write operation: {name}")
+    if name == 'insertOne':
+        return pymongo.InsertOne(spec.get('document', spec))
+    return BULK_OPERATIONS[name](**{BULK_OPTION_NAMES.get(k, k): v for k, v in spec.items()})
+
+def summarize_update(r):
+    result = {"matched_count": r.matched_count, "modified_count": r.modified_count}
+    message = f"Matched: {r.matched_count}, Modified: {r.modified_count}"
+    if r.upserted_id is not None:
+        result["upserted_id"] = str(r.upserted_id)
+        message += f", Upserted: {r.upserted_id}"
+    return result, message
+
+def summarize_bulk(r):
+    result = {
+        "inserted_count": r.inserted_count, "matched_count": r.matched_count,
+        "modified_count": r.modified_count, "deleted_count": r.deleted_count,
+        "upserted_count": r.upserted_count,
+    }
+    return result, ", ".join(f"{k.split('_')[0].capitalize()}: {v}" for k, v in result.items())
+
+def summarize_value(value):
+    return value, json_util.dumps(value, indent=2, ensure_ascii=False)
+
+# db.<coll>.<method>(...) dispatch table: method -> summarizer of the pymongo
+# return value as (result, message). Cursor methods have no summarizer and
+# are streamed through write_results instead.
+COLLECTION_METHODS = {
+    'find': None,
+    'aggregate': None,
+    'insert_one': lambda r: ({"inserted_id": str(r.inserted_id)}, f"Inserted: {r.inserted_id}"),
+    'insert_many': lambda r: ({"inserted_ids": [str(i) for i in r.inserted_ids]}, f"Inserted: {len(r.inserted_ids)}"),
+    'update_one': summarize_update,
+    'update_many': summarize_update,
+    'replace_one': summarize_update,
+    'delete_one': lambda r: ({"deleted_count": r.deleted_count}, f"Deleted: {r.deleted_count}"),
+    'delete_many': lambda r: ({"deleted_count": r.deleted_count}, f"Deleted: {r.deleted_count}"),
+    'bulk_write': summarize_bulk,
+    'find_one': summarize_value,
+    'find_one_and_update': summarize_value,
+    'find_one_and_replace': summarize_value,
+    'find_one_and_delete': summarize_value,
+    'count_documents': summarize_value,
+    'estimated_document_count': summarize_value,
+    'distinct': summarize_value,
+}
+
+# Methods that only read, and so may run concurrently inside parallel { ... }
+READ_METHODS = ('find', 'aggregate', 'find_one', 'count_documents', 'estimated_document_count', 'distinct')
+
+# Methods a SELECT COUNT translates to; the count comes back as {plan.output: n}
+COUNT_METHODS = ('count_documents', 'estimated_document_count')
+
+def is_read_statement(command):
+    """Return True for SELECTs and db.<coll>.<read method>(...) calls without $out/$merge."""
+    command = command.strip()
+    if command.upper().startswith('SELECT'):
+        return True
+    m = re.match(r"db\.\w+\.(\w+)\(", command)
+    return (m is not None and m.group(1) in READ_METHODS
+            and re.search(r"['\"]\$(out|merge)['\"]", command) is None)
+
+def parse_db_command(command):
+    """Split `db.<coll>.<method>(<args>)` into (collection, method, args, kwargs).
+
+    Raises ValueError with a user-facing message for malformed commands.
+    """
+    rest = command[3:]
+    if '.' not in rest:
+        raise ValueError("Invalid command.")
+    collection, rest = rest.split('.', 1)
+    if '(' not in rest or not rest.endswith(')'):
+        raise ValueError("Invalid command.")
+    method, argstr = rest.split('(', 1)
+    argstr = argstr[:-1]  # Remove trailing ')'
+    try:
+        args, kwargs = parse_call_args(argstr)
+    except (SyntaxError, ValueError):
+        raise ValueError("Invalid argument format.")
+    if method not in COLLECTION_METHODS:
+        raise ValueError("Unsupported method.")
+    return collection, method, args, kwargs
+
+def prepare_method_args(method, args, kwargs):
+    """Convert shell literals into the objects pymongo expects for a method."""
+    if method == 'bulk_write' and args:
+        args[0] = [to_bulk_operation(op) for op in args[0]]
+    if isinstance(kwargs.get('return_document'), str):
+        kwargs['return_document'] = kwargs['return_document'].lower() == 'after'
+    return args, kwargs
+
+class SchemaCache:
+    """Field names per (connection, database, collection), learned by sampling.
+
+    Each collection is sampled once with $sample; the field names of the
+    sampled documents are merged in first-seen order and reused until the
+    entry is older than ttl seconds or is refreshed explicitly.
+    """
+    def __init__(self, sample_size=100, ttl=300):
+        self.sample_size = sample_size
+        self.ttl = ttl
+        self.entries = {}  # (conn, db, collection) -> (sampled_at, fields)
+
+    def fields(self, db, collection, conn=None):
+        key = (conn, db.name, collection)
+        entry = self.entries.get(key)
+        if entry is not None and (self.ttl <= 0 or time.time() - entry[0] < self.ttl):
+            return entry[1]
+        pipeline = [
+            {"$sample": {"size": self.sample_size}},
+            # Only the key names travel back, not the sampled documents
+            {"$project": {"_id": 0, "keys": {"$map": {"input": {"$objectToArray": "$$ROOT"}, "in": "$$this.k"}}}},
+        ]
+        fields = []
+        seen = set()
+        for doc in db[collection].aggregate(pipeline):
+            for k in doc.get('keys', []):
+                if k not in seen:
+                    seen.add(k)
+                    fields.append(k)
+        self.entries[key] = (time.time(), fields)
+        return fields
+
+    def refresh(self, collection=None):
+        """Forget sampled fields for one collection, or for all of them."""
+        if collection is None:
+            self.entries.clear()
+        else:
+            for key in [k for k in self.entries if k[2] == collection]:
+                del self.entries[key]
+
+def pipeline_collections(pipeline):
+    """Collections read by $lookup, $graphLookup and $unionWith stages, nested ones included."""
+    found = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in ('$lookup', '$graphLookup') and isinstance(value, dict) and 'from' in value:
+                    found.add(value['from'])
+                elif key == '$unionWith':
+                    found.add(value if isinstance(value, str) else value.get('coll'))
+                walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(pipeline or [])
+    found.discard(None)
+    return found
+
+def pipeline_output(pipeline):
+    """Name of the collection a $out/$merge stage writes to, or None."""
+    for stage in pipeline or []:
+        target = stage.get('$out', stage.get('$merge')) if isinstance(stage, dict) else None
+        if isinstance(target, dict):
+            target = target.get('into', target.get('coll'))
+            if isinstance(target, dict):
+                target = target.get('coll')
+        if target:
+            return target
+    return None
+
+class ResultCache:
+    """Results of read queries, kept in an LRU bounded by their BSON size.
+
+    Entries are keyed by (connection, database, collection, query) and
+    remember every collection the query read, so a write to any of them
+    drops the entry. Entries expire after ttl seconds (0 keeps them until
+    invalidated).
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (cached_at, collections, size, docs)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0  # bumped by every invalidation, so in-flight reads don't store stale results
+        self.lock = threading.Lock()
+        self.watchers = set()  # (conn, db) pairs with a change stream running
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl <= 0 or time.time() - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[3]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def record(self, key, collections, docs):
+        """Yield docs, caching them once the cursor is exhausted if they fit."""
+        generation = self.generation
+        kept, size = [], 0
+        for doc in docs:
+            if kept is not None:
+                size += len(bson.encode(doc))
+                if size > self.max_bytes:
+                    kept = None
+                else:
+                    kept.append(doc)
+            yield doc
+        if kept is None:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.time(), collections, size, kept)
+            self.size += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def invalidate(self, conn, db, collection=None):
+        """Drop entries that read collection (every collection of db if None)."""
+        with self.lock:
+            self.generation += 1
+            for key, entry in list(self.entries.items()):
+                if key[:2] == (conn, db) and (collection is None or collection in entry[1]):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def watch(self, conn, db):
+        """Invalidate entries of db from a change stream on a background thread."""
+        with self.lock:
+            if (conn, db.name) in self.watchers:
+                return
+            self.watchers.add((conn, db.name))
+
+        def run():
+            try:
+                with db.watch() as stream:
+                    for change in stream:
+                        self.invalidate(conn, db.name, change.get('ns', {}).get('coll'))
+            except pymongo.errors.PyMongoError as e:
+                # Standalone servers have no change streams; writes through the shell still invalidate
+                print(f"Result cache change stream on {db.name} stopped: {e}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (f"{len(self.entries)} entries, {self.size / 1048576:.1f} of {self.max_bytes / 1048576:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), "
+                f"{self.invalidations} invalidated")
+
+# Change stream positions of `watch`, keyed by connection, database, collection and filter
+RESUME_TOKEN_FILE = '~/.pymdbsh_resume.json'
+RESUME_TOKEN_LOCK = threading.Lock()
+# Seconds between resume token saves while watching
+RESUME_SAVE_INTERVAL = 1.0
+
+def change_stream_filter(node, expr=False):
+    """Rewrite a find filter to test the fullDocument of change events.
+
+    expr is set inside $expr, where `$field` strings are field paths.
+    """
+    if isinstance(node, list):
+        return [change_stream_filter(item, expr) for item in node]
+    if expr and isinstance(node, str) and node.startswith('$') and not node.startswith('$$'):
+        return f"$fullDocument.{node[1:]}"
+    if not isinstance(node, dict):
+        return node
+    out = {}
+    for key, value in node.items():
+        if expr or key == '$expr':
+            out[key] = change_stream_filter(value, True)
+        elif key in ('$and', '$or', '$nor'):
+            out[key] = change_stream_filter(value)
+        elif key.startswith('$'):
+            out[key] = value
+        else:
+            out[f"fullDocument.{key}"] = value
+    return out
+
+def change_stream_pipeline(filter_doc):
+    """$match for the inserts, updates and deletes of documents matching filter_doc.
+
+    Deleted documents are gone by the time the event is read, so deletes
+    are passed through unfiltered.
+    """
+    if not filter_doc:
+        return [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    return [{"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "update", "replace"]}, **change_stream_filter(filter_doc)},
+        {"operationType": "delete"},
+    ]}}]
+
+def load_resume_tokens(path):
+    try:
+        with open(path, encoding='utf-8') as fh:
+            return json_util.loads(fh.read())
+    except (OSError, ValueError):
+        return {}
+
+def save_resume_token(path, key, token):
+    """Store a resume token under key, replacing the token file atomically."""
+    with RESUME_TOKEN_LOCK:
+        tokens = load_resume_tokens(path)
+        tokens[key] = token
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            fh.write(json_util.dumps(tokens, indent=2))
+        os.replace(tmp_path, path)
+
+class PhaseTimer:
+    """Wall-clock time per phase of one command, for `timing on`."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = OrderedDict()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def iterate(self, docs):
+        """Yield from docs, charging the time spent waiting on the cursor to fetch."""
+        it = iter(docs)
+        first = True
+        while True:
+            start = time.perf_counter()
+            try:
+                doc = next(it)
+            except StopIteration:
+                self.add('fetch', time.perf_counter() - start)
+                return
+            elapsed = time.perf_counter() - start
+            if first:
+                self.add('first batch', elapsed)
+                first = False
+            self.add('fetch', elapsed)
+            yield doc
+
+    def report(self):
+        total = time.perf_counter() - self.started
+        parts = [f"{name} {seconds * 1000:.2f} ms" for name, seconds in self.phases.items()]
+        return "Timing: " + ", ".join(parts + [f"total {total * 1000:.2f} ms"])
+
+class TimedWriter:
+    """File-like proxy that charges write and flush time to the output phase."""
+    def __init__(self, out, timer):
+        self.out = out
+        self.timer = timer
+
+    def write(self, text):
+        with self.timer.phase('output'):
+            return self.out.write(text)
+
+    def flush(self):
+        with self.timer.phase('output'):
+            return self.out.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+def explain_spec(collection, method, args, kwargs):
+    """Build the find/aggregate/count command document that `explain` wraps."""
+    if method == 'count_documents':
+        # The pipeline count_documents runs on the server
+        filter_doc = args[0] if args else kwargs.get('filter', {})
+        pipeline = [{"$match": filter_doc}, {"$group": {"_id": 1, "n": {"$sum": 1}}}]
+        return {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+    if method == 'estimated_document_count':
+        return {"count": collection}
+    if method == 'aggregate':
+        pipeline = args[0] if args else kwargs.get('pipeline', [])
+        return {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+    spec = {"find": collection, "filter": args[0] if args else kwargs.get('filter', {})}
+    projection = args[1] if len(args) > 1 else kwargs.get('projection')
+    if projection:
+        spec['projection'] = projection
+    sort = kwargs.get('sort')
+    if sort:
+        spec['sort'] = dict(sort)
+    for option in ('skip', 'limit'):
+        if kwargs.get(option):
+            spec[option] = kwargs[option]
+    return spec
+
+def find_in_explain(node, key):
+    """Depth-first search for the first value stored under key in an explain document."""
+    if isinstance(node, dict):
+        if key in node:
+            return node[key]
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+    for child in children:
+        found = find_in_explain(child, key)
+        if found is not None:
+            return found
+    return None
+
+def format_explain(result):
+    """Summarize executionStats explain output: plan, index, docs examined vs returned, sorts."""
+    planner = find_in_explain(result, 'queryPlanner') or {}
+    stats = find_in_explain(result, 'executionStats') or {}
+    winning = planner.get('winningPlan', {})
+    winning = winning.get('queryPlan', winning)
+    stages = []
+    indexes = []
+
+    def walk(node):
+        stages.append(node.get('stage', '?'))
+        if node.get('indexName'):
+            indexes.append(f"{node['indexName']} {json_util.dumps(node.get('keyPattern', {}))}")
+        for child in [node.get('inputStage')] + node.get('inputStages', []):
+            if child:
+                walk(child)
+
+    if winning:
+        walk(winning)
+    pipeline_stages = [next(iter(stage)) for stage in result.get('stages', [])]
+    in_memory_sort = 'SORT' in stages or '$sort' in pipeline_stages
+    lines = [
+        f"Winning plan: {' <- '.join(stages) or 'n/a'}",
+        f"Index used: {', '.join(indexes) if indexes else 'none (collection scan)' if 'COLLSCAN' in stages else 'none'}",
+        f"Documents examined: {stats.get('totalDocsExamined', '?')}, "
+        f"keys examined: {stats.get('totalKeysExamined', '?')}, "
+        f"returned: {stats.get('nReturned', '?')}",
+        f"In-memory sort: {'yes' if in_memory_sort else 'no'}",
+        f"Execution time: {stats.get('executionTimeMillis', '?')} ms",
+    ]
+    if pipeline_stages:
+        lines.append(f"Pipeline stages: {', '.join(pipeline_stages)}")
+    return "\n".join(lines)
+
+def query_shapes(collection, method, args, kwargs):
+    """(collection, filter, sort) pairs a query asks indexes to answer.
+
+    For a pipeline these are its leading $match stages and $sort, plus the
+    foreignField (and inner $match) of each $lookup on the joined collection.
+    """
+    if method in ('find', 'count_documents'):
+        filter_doc = args[0] if args else kwargs.get('filter', {})
+        sort = kwargs.get('sort') if method == 'find' else None
+        return [(collection, filter_doc, sort)]
+    if method != 'aggregate':
+        return []
+    pipeline = args[0] if args else kwargs.get('pipeline', [])
+    filters, sort = [], None
+    for stage in pipeline:
+        if '$match' in stage and sort is None:
+            filters.append(stage['$match'])
+        elif '$sort' in stage and sort is None:
+            sort = stage['$sort']
+        else:
+            break
+    shapes = [(collection, merge_conjunction(filters), sort)] if filters or sort else []
+    for stage in pipeline:
+        lookup = stage.get('$lookup')
+        if lookup and 'foreignField' in lookup:
+            inner = [s['$match'] for s in lookup.get('pipeline', []) if '$match' in s][:1]
+            key = {lookup['foreignField']: {"$eq": f"${lookup['localField']}"}}
+            shapes.append((lookup['from'], merge_conjunction([key] + inner), None))
+    return shapes
+
+def esr_fields(filter_doc, sort=None):
+    """Split a query into the equality, sort and range parts of the ESR rule.
+
+    Returns (equality paths, [(path, direction), ...] sort keys, range
+    paths). Conditions under $or, $nor or $expr can't be served by one
+    compound index and are left out. $in counts as equality unless the
+    query also sorts, where it would need a blocking sort and acts as a
+    range instead.
+    """
+    sort = list(sort.items() if isinstance(sort, dict) else sort or [])
+    equality, ranges = [], []
+    for cond in filter_conjuncts(filter_doc or {}):
+        (path, value), = cond.items()
+        if path.startswith('$'):
+            continue
+        ops = value if isinstance(value, dict) and value and all(k.startswith('$') for k in value) else {'$eq': value}
+        bucket = equality if set(ops) == {'$eq'} or (set(ops) == {'$in'} and not sort) else ranges
+        if path not in bucket:
+            bucket.append(path)
+    sort_keys = [(path, direction) for path, direction in sort if path not in equality]
+    sorted_paths = {path for path, _ in sort_keys}
+    ranges = [path for path in ranges if path not in equality and path not in sorted_paths]
+    return equality, sort_keys, ranges
+
+def index_serves(key, equality, sort_keys, ranges):
+    """True if an index key pattern answers the query without a collection scan or in-memory sort.
+
+    The equality fields must lead (in any order), followed by the sort
+    keys (all in their own or all in the reverse direction), then the
+    range fields.
+    """
+    paths = [path for path, _ in key]
+    n = len(equality)
+    if set(paths[:n]) != set(equality):
+        return False
+    head = list(key[n:n + len(sort_keys)])
+    if [path for path, _ in head] != [path for path, _ in sort_keys]:
+        return False
+    if head and not (all(d == s for (_, d), (_, s) in zip(head, sort_keys))
+                     or all(d == -s for (_, d), (_, s) in zip(head, sort_keys))):
+        return False
+    n += len(sort_keys)
+    return set(paths[n:n + len(ranges)]) == set(ranges)
+
+def format_index_key(key):
+    """Key pattern as `create index` columns, e.g. `city, created DESC`."""
+    return ', '.join(path if direction == 1 else f"{path} DESC" if direction == -1 else f"{path} {direction}"
+                     for path, direction in key)
+
+class JobCancelled(Exception):
+    """Raised in a job's thread once the job has been cancelled."""
+
+class Job:
+    """One command running on its own thread, in the foreground or the background.
+
+    Output printed by the job goes straight to the terminal while it is in
+    the foreground and is buffered while it runs in the background. Jobs
+    that aren't pageable always print their results in full.
+    """
+    def __init__(self, job_id, command, client, foreground, stream, pageable=True):
+        self.id = job_id
+        self.command = command
+        self.client = client
+        self.foreground = foreground
+        self.pageable = pageable
+        self.stream = stream
+        self.buffer = io.StringIO()
+        self.lock = threading.Lock()
+        self.cursors = []
+        self.cancelled = False
+        self.status = 'running'
+        self.announced = False
+        self.result = None
+        self.started = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def tag(self):
+        # Sent as the operation comment so killOp can find the job's server-side work
+        return f"pymdbsh-{os.getpid()}-job-{self.id}"
+
+    def write(self, text):
+        with self.lock:
+            return (self.stream if self.foreground else self.buffer).write(text)
+
+    def flush(self):
+        with self.lock:
+            if self.foreground:
+                self.stream.flush()
+
+    def to_foreground(self):
+        """Print what the job buffered so far and stream the rest directly."""
+        with self.lock:
+            self.stream.write(self.buffer.getvalue())
+            self.stream.flush()
+            self.buffer = io.StringIO()
+            self.foreground = True
+
+    def to_background(self):
+        with self.lock:
+            self.foreground = False
+
+    def check(self, docs):
+        """Yield from docs until the job is cancelled."""
+        for doc in docs:
+            if self.cancelled:
+                raise JobCancelled()
+            yield doc
+
+class JobOutput:
+    """sys.stdout proxy that sends each job thread's output to its job."""
+    def __init__(self, stream, local):
+        self.stream = stream
+        self.local = local
+
+    def target(self):
+        job = getattr(self.local, 'job', None)
+        return job if job is not None else self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# Full SQL pages whose last _id is remembered for keyset OFFSET pagination
+KEYSET_BOOKMARKS = 1000
+
+# Seconds Ctrl-C waits for a cancelled job before leaving it to finish in the background
+CANCEL_GRACE = 2.0
+
+# Per-connection pool options accepted in ~/.pymdbsh.conf sections
+POOL_OPTIONS = ('maxPoolSize', 'minPoolSize', 'maxIdleTimeMS')
+
+class CommandExpander:
+    """Alias and $variable expansion of command lines.
+
+    An alias matches the longest alias name (case-insensitive) that starts
+    the line and ends at whitespace or the end of the line, found by
+    walking a character trie. Its body may start with another alias;
+    each alias is used at most once per expansion. `$name` references are
+    replaced in a single pass of one compiled regex, and only at a word
+    boundary, so `$user` leaves `$user_id` alone. The trie, the regex and
+    the fully expanded alias bodies are built on first use after a
+    variable or alias changes.
+    """
+    def __init__(self, variables=None, aliases=None):
+        self.variables = dict(variables or {})
+        self.aliases = dict(aliases or {})
+        self.compiled = None  # (trie, variable regex, alias name -> expanded body)
+
+    def set_variable(self, name, value):
+        self.variables[name] = value
+        self.compiled = None
+
+    def set_alias(self, name, command):
+        self.aliases[name] = command
+        self.compiled = None
+
+    def compile(self):
+        compiled = self.compiled
+        if compiled is not None:
+            return compiled
+        trie = {}
+        for name in self.aliases:
+            node = trie
+            for c in name.lower():
+                node = node.setdefault(c, {})
+            node[None] = name
+        pattern = None
+        if self.variables:
+            names = sorted(self.variables, key=len, reverse=True)
+            pattern = re.compile(r"\$(" + "|".join(re.escape(n) for n in names) + r")(?!\w)")
+        compiled = (trie, pattern, {})
+        templates = compiled[2]
+        for name in self.aliases:
+            body, used = self.aliases[name], {name}
+            while True:
+                match = self.match_alias(trie, body, used)
+                if match is None:
+                    break
+                inner, end = match
+                used.add(inner)
+                body = f"{self.aliases[inner]} {body[end:].strip()}".strip()
+            templates[name] = self.substitute(body, pattern)
+        self.compiled = compiled
+        return compiled
+
+    @staticmethod
+    def match_alias(trie, line, skip=()):
+        """(alias name, end offset) of the longest alias starting line, or None."""
+        node = trie
+        best = None
+        for i, c in enumerate(line.lower()):
+            node = node.get(c)
+            if node is None:
+                break
+            name = node.get(None)
+            if name is not None and name not in skip and (i + 1 == len(line) or line[i + 1].isspace()):
+                best = (name, i + 1)
+        return best
+
+    def substitute(self, text, pattern):
+        if pattern is None or '$' not in text:
+            return text
+        return pattern.sub(lambda m: str(self.variables[m.group(1)]), text)
+
+    def substitute_vars(self, text):
+        return self.substitute(text, self.compile()[1])
+
+    def expand(self, line):
+        """Expand a leading alias and the $variables of a command line."""
+        trie, pattern, templates = self.compile()
+        match = self.match_alias(trie, line)
+        if match is None:
+            return self.substitute(line, pattern)
+        name, end = match
+        return f"{templates[name]} {self.substitute(line[end:].strip(), pattern)}".strip()
 
 class MongoCLI:
     def __init__(self, config_file_path):
-        self.client = None
-        self.db = None
-        self.variables = {}
-        self.aliases = {}
+        self._client = None
+        self._db = None
+        self.pending_conn = None  # connection to open on first use of client/db
+        self.connect_lock = threading.Lock()
+        self.clients = {}  # connection name -> live MongoClient, reused across use/switch
+        self.wire_versions = {}  # connection name -> server maxWireVersion, from hello
+        self.expander = CommandExpander()
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.plan_cache = PlanCache()
+        self.schema_cache = SchemaCache()
+        self.result_cache = ResultCache()
+        self.encode = json_util_encoder()  # document serializer, from the serializer/json_mode settings
+        self.interactive = False  # set by run_session; pages query results
+        self.failed = False  # set by report_error; -c/-f/stdin runs then exit with status 1
+        self.pager_cursor = None  # live cursor of the paged result, for it/next
+        self.pager_docs = None
+        self.pager_columns = None
+        self.keyset_bookmarks = OrderedDict()  # ((conn, db, coll, query), offset) -> last _id
+        self.local = threading.local()  # job and PhaseTimer of the command running on this thread
+        self.jobs = OrderedDict()  # job id -> Job, until finished jobs are collected with fg/kill
+        self.next_job_id = 1
         self.configs = self.load_config(config_file_path)
         self.current_conn = list(self.configs.keys())[0] if self.configs else None
-        if self.current_conn:
-            self.connect(self.current_conn)
+        # Connect lazily: commands that never touch the server skip the round trip
+        self.pending_conn = self.current_conn
 
     def load_config(self, path):
         configs = {}
@@ -33,18 +1436,30 @@ class MongoCLI:
                 if section.lower() == "variables":
                     for k, v in parser.items(section):
                         variables[k] = v
+                elif section.lower() == "settings":
+                    for k, v in parser.items(section):
+                        if k in DEFAULT_SETTINGS:
+                            try:
+                                self.settings[k] = coerce_setting(k, v)
+                            except ValueError as e:
+                                print(f"Ignoring setting '{k}': {e}")
+                        else:
+                            print(f"Unknown setting '{k}' in [settings].")
                 elif section.lower() == "aliases":
                     for k, v in parser.items(section):
-                        for var_k, var_v in variables.items():
-                            v = v.replace(f"${var_k}", str(var_v))
                         aliases[k] = v
                 else:
                     # Support connection_string or host/port
                     conn_string = parser.get(section, 'connection_string', fallback=None)
+                    pool_options = {}
+                    for option in POOL_OPTIONS:
+                        if parser.has_option(section, option):
+                            pool_options[option] = parser.getint(section, option)
                     if conn_string:
                         configs[section] = {
                             'connection_string': conn_string,
-                            'database': parser.get(section, 'database', fallback=None)
+                            'database': parser.get(section, 'database', fallback=None),
+                            'pool_options': pool_options
                         }
                     else:
                         configs[section] = {
@@ -52,209 +1467,1191 @@ class MongoCLI:
                             'port': parser.getint(section, 'port', fallback=27017),
                             'username': parser.get(section, 'username', fallback=None),
                             'password': parser.get(section, 'password', fallback=None),
-                            'database': parser.get(section, 'database', fallback=None)
+                            'database': parser.get(section, 'database', fallback=None),
+                            'pool_options': pool_options
                         }
-        self.variables = variables
-        self.aliases = aliases
+        self.expander = CommandExpander(variables, aliases)
+        self.apply_settings()
         return configs
 
     def connect(self, conn_name):
+        self.pending_conn = None
         cfg = self.configs[conn_name]
         try:
-            if 'connection_string' in cfg and cfg['connection_string']:
-                self.client = pymongo.MongoClient(cfg['connection_string'],datetime_conversion='DATETIME_AUTO', serverSelectionTimeoutMS=5000)
+            client = self.clients.get(conn_name)
+            if client is None:
+                client = self.create_client(cfg)
+                self.clients[conn_name] = client
+            self.client = client
+            self.db = self.client[cfg['database']]
+            self.current_conn = conn_name
+        except Exception as e:
+            self.report_error(f"Connection to '{conn_name}' failed: {e}")
+            self.client = None
+            self.db = None
+            self.current_conn = None
+
+    def create_client(self, cfg):
+        """Create a MongoClient for a connection config and verify it is reachable."""
+        pool_options = cfg.get('pool_options', {})
+        if 'connection_string' in cfg and cfg['connection_string']:
+            client = pymongo.MongoClient(cfg['connection_string'], datetime_conversion='DATETIME_AUTO',
+                                         serverSelectionTimeoutMS=5000, **pool_options)
+        else:
+            uri = f"mongodb://{cfg['host']}:{cfg['port']}/"
+            if cfg.get('username') and cfg.get('password'):
+                uri = f"mongodb://{cfg['username']}:{cfg['password']}@{cfg['host']}:{cfg['port']}/"
+            client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=5000, **pool_options)
+        try:
+            # Attempt to fetch server info to trigger connection
+            client.server_info()
+        except Exception:
+            client.close()
+            raise
+        return client
+
+    def connect_pending(self):
+        with self.connect_lock:
+            if self.pending_conn is not None:
+                conn, self.pending_conn = self.pending_conn, None
+                self.connect(conn)
+
+    @property
+    def client(self):
+        if self._client is None and self.pending_conn is not None:
+            self.connect_pending()
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    @property
+    def db(self):
+        if self._db is None and self.pending_conn is not None:
+            self.connect_pending()
+        return self._db
+
+    @db.setter
+    def db(self, value):
+        self._db = value
+
+    @property
+    def timer(self):
+        return getattr(self.local, 'timer', None)
+
+    @timer.setter
+    def timer(self, value):
+        self.local.timer = value
+
+    @property
+    def job(self):
+        return getattr(self.local, 'job', None)
+
+    def close(self):
+        """Close every pooled client."""
+        self.pager_cursor = self.pager_docs = None
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+        self.wire_versions.clear()
+        self.client = None
+        self.db = None
+
+    def apply_settings(self):
+        """Push settings into the caches that use them."""
+        self.plan_cache.maxsize = self.settings['plan_cache_size']
+        self.schema_cache.sample_size = max(self.settings['schema_sample_size'], 1)
+        self.schema_cache.ttl = self.settings['schema_ttl']
+        self.encode = make_encoder(self.settings['serializer'], self.settings['json_mode'])
+        self.result_cache.resize(self.settings['result_cache_bytes'])
+        self.result_cache.ttl = self.settings['result_cache_ttl']
+        if not self.settings['result_cache']:
+            self.result_cache.clear()
+
+    def wire_version(self):
+        """The current server's maxWireVersion, asked once per connection; 0 if unknown."""
+        version = self.wire_versions.get(self.current_conn)
+        if version is None:
+            try:
+                version = self.client.admin.command('hello').get('maxWireVersion', 0)
+            except Exception:
+                # Servers before 4.4.2 have no hello; they are older than 5.0 anyway
+                version = 0
+            self.wire_versions[self.current_conn] = version
+        return version
+
+    def optimize_plan(self, plan):
+        """Run the pipeline optimizer on an aggregate plan, printing both pipelines if show_plan is on."""
+        pipeline = plan.args[0]
+        if self.settings['optimize']:
+            # localField/foreignField together with a pipeline needs MongoDB 5.0 (wire version 13)
+            optimized = optimize_pipeline(pipeline, lookup_pipeline=self.wire_version() >= 13)
+        else:
+            optimized = pipeline
+        if self.settings['show_plan']:
+            print("Pipeline:")
+            print(json_util.dumps(pipeline, indent=2, ensure_ascii=False))
+            print("Optimized pipeline:")
+            print(json_util.dumps(optimized, indent=2, ensure_ascii=False))
+        return plan._replace(args=[optimized] + plan.args[1:])
+
+    def collection_fields(self, collection):
+        """Sampled field names of a collection in the current database."""
+        return self.schema_cache.fields(self.db, collection, self.current_conn)
+
+    def timed(self, phase):
+        """Context manager charging its block to a phase when timing is on."""
+        return self.timer.phase(phase) if self.timer is not None else contextlib.nullcontext()
+
+    def report_error(self, message, show=True):
+        """Record a failed command and print why; -c/-f/stdin runs print it to stderr."""
+        self.failed = True
+        self.local.failed = True
+        if show:
+            print(message, file=sys.stdout if self.interactive else sys.stderr)
+
+    def translate(self, sql):
+        """Translate a SELECT through the plan cache, reporting unsupported SQL as an error."""
+        return sql_to_mongo(sql, self.plan_cache, self.collection_fields, self.report_error)
+
+    def write_results(self, docs, out=None, output_format=None, columns=None):
+        """Stream an iterable of documents to out (stdout by default).
+
+        columns, when known from the query, fixes the columns of tabular formats.
+        """
+        out = out if out is not None else sys.stdout
+        output_format = output_format or self.settings['format']
+        writer = RESULT_WRITERS[output_format]
+        if output_format in TABULAR_FORMATS:
+            writer = functools.partial(writer, columns=columns)
+        if self.job is not None:
+            docs = self.job.check(docs)
+        timer = self.timer
+        if timer is None:
+            return writer(docs, out, self.settings['batch_size'], self.encode)
+        # Serialization is what remains once cursor waits and writes are taken out
+        fetch, output = timer.phases.get('fetch', 0.0), timer.phases.get('output', 0.0)
+        start = time.perf_counter()
+        count = writer(timer.iterate(docs), TimedWriter(out, timer), self.settings['batch_size'], self.encode)
+        elapsed = time.perf_counter() - start
+        timer.add('serialize', elapsed - (timer.phases.get('fetch', 0.0) - fetch)
+                  - (timer.phases.get('output', 0.0) - output))
+        return count
+
+    def query_spec(self, query, command):
+        """(collection, method, args, kwargs) of a find/aggregate/SELECT given to explain or advise.
+
+        Prints the problem and returns None for anything else.
+        """
+        query = query.strip()
+        if query.upper().startswith('SELECT'):
+            plan = self.translate(query)
+            if not plan:
+                return None
+            if plan.method == 'aggregate':
+                plan = self.optimize_plan(plan)
+            plan, _ = self.keyset_plan(plan)
+            return plan.collection, plan.method, plan.args, {'sort': plan.sort, 'limit': plan.limit, 'skip': plan.skip}
+        if query.startswith('db.'):
+            try:
+                collection, method, args, kwargs = parse_db_command(query)
+            except ValueError as e:
+                print(e)
+                return None
+            if method not in ('find', 'aggregate', 'count_documents'):
+                print(f"{command} supports find, aggregate, count_documents and SELECT queries.")
+                return None
+            return collection, method, args, kwargs
+        print(f"Usage: {command} <db.collection.find(...)|db.collection.aggregate(...)|SELECT ...>")
+        return None
+
+    def explain(self, query):
+        """Run a find/aggregate/SELECT through explain in executionStats mode and summarize it."""
+        spec = self.query_spec(query, 'explain')
+        if spec is None:
+            return
+        result = self.db.command('explain', explain_spec(*spec), verbosity='executionStats')
+        print(format_explain(result))
+
+    def advise(self, query):
+        """Suggest ESR compound indexes for a query, unless an existing index already serves it."""
+        spec = self.query_spec(query, 'advise')
+        if spec is None:
+            return
+        suggested = False
+        for collection, filter_doc, sort in query_shapes(*spec):
+            equality, sort_keys, ranges = esr_fields(filter_doc, sort)
+            key = [(path, 1) for path in equality] + sort_keys + [(path, 1) for path in ranges]
+            if not key:
+                continue
+            suggested = True
+            parts = [f"{label}: {', '.join(paths)}" for label, paths in
+                     (('equality', equality), ('sort', [p for p, _ in sort_keys]), ('range', ranges)) if paths]
+            print(f"{collection}: {'; '.join(parts)}")
+            indexes = self.db[collection].index_information()
+            serving = [name for name, info in indexes.items()
+                       if index_serves(info['key'], equality, sort_keys, ranges)]
+            if serving:
+                print(f"  Served by existing index {serving[0]}.")
+                continue
+            print(f"  No index serves this. Suggested:\n    create index on {collection} ({format_index_key(key)})")
+            # Indexes the new one starts with become redundant
+            covered = [name for name, info in indexes.items()
+                       if name != '_id_' and list(info['key']) == key[:len(info['key'])]]
+            if covered:
+                print(f"  It makes {', '.join(covered)} redundant.")
+        if not suggested:
+            print("Nothing to index: the query has no filter or sort.")
+
+    def advise_profile(self, limit=10):
+        """Rank suggested indexes by the time profiled operations spent without them.
+
+        Reads collection scans and in-memory sorts recorded in the current
+        database's system.profile (the profiler must be on) and groups them
+        by the index that would serve each one.
+        """
+        slow = self.db['system.profile'].find(
+            {'$or': [{'planSummary': {'$regex': '^COLLSCAN'}}, {'hasSortStage': True}]},
+            {'ns': 1, 'command': 1, 'originatingCommand': 1, 'millis': 1})
+        candidates = {}  # (collection, key) -> [operations, milliseconds, ESR fields]
+        for entry in slow:
+            command = entry.get('originatingCommand') or entry.get('command') or {}
+            collection = entry.get('ns', '').split('.', 1)[-1]
+            if 'find' in command:
+                shapes = query_shapes(collection, 'find', [command.get('filter', {})], {'sort': command.get('sort')})
+            elif 'aggregate' in command:
+                shapes = query_shapes(collection, 'aggregate', [command.get('pipeline', [])], {})
+            elif 'count' in command:
+                shapes = query_shapes(collection, 'count_documents', [command.get('query') or {}], {})
+            else:
+                continue
+            for coll, filter_doc, sort in shapes[:1]:
+                equality, sort_keys, ranges = esr_fields(filter_doc, sort)
+                key = tuple([(path, 1) for path in equality] + sort_keys + [(path, 1) for path in ranges])
+                if key:
+                    totals = candidates.setdefault((coll, key), [0, 0, (equality, sort_keys, ranges)])
+                    totals[0] += 1
+                    totals[1] += entry.get('millis', 0)
+        ranked = []
+        for (collection, key), (ops, millis, fields) in candidates.items():
+            # Skip queries an index created since then already serves
+            indexes = self.db[collection].index_information()
+            if not any(index_serves(info['key'], *fields) for info in indexes.values()):
+                ranked.append((millis, ops, collection, key))
+        if not ranked:
+            print("No unindexed operations in system.profile (is the profiler on?).")
+            return
+        ranked.sort(reverse=True)
+        for i, (millis, ops, collection, key) in enumerate(ranked[:limit], 1):
+            print(f"{i:>2}. {millis} ms in {ops} ops: create index on {collection} ({format_index_key(key)})")
+
+    def show_indexes(self, collection):
+        """List a collection's indexes with their key patterns and options."""
+        print(f"Indexes on {collection}:")
+        for name, info in self.db[collection].index_information().items():
+            options = [f"{k}={json_util.dumps(v)}" for k, v in info.items() if k not in ('key', 'v', 'ns')]
+            print(f"  {name}: {format_index_key(info['key'])}{'  ' + ' '.join(options) if options else ''}")
+
+    def create_index(self, collection, columns, name=None, unique=False):
+        """Create an index from `field [ASC|DESC|text|hashed|2dsphere], ...` columns."""
+        key = []
+        for column in columns.split(','):
+            parts = column.split()
+            if not parts or len(parts) > 2:
+                print(f"Invalid index column '{column.strip()}'.")
+                return
+            kind = parts[1].lower() if len(parts) == 2 else 'asc'
+            direction = {'asc': 1, '1': 1, 'desc': -1, '-1': -1}.get(kind, kind)
+            key.append((parts[0], direction))
+        options = {'unique': True} if unique else {}
+        if name:
+            options['name'] = name
+        created = self.db[collection].create_index(key, **options)
+        print(f"Created index {created} on {collection}.")
+
+    def open_cursor(self, coll, method, args, sort=None, limit=None, skip=None, **kwargs):
+        """Open a find/aggregate cursor that fetches batch_size documents per round trip."""
+        batch_size = self.settings['batch_size']
+        job = self.job
+        if job is not None:
+            kwargs.setdefault('comment', job.tag)
+        if method == 'aggregate':
+            if batch_size:
+                kwargs.setdefault('batchSize', batch_size)
+            cursor = coll.aggregate(*args, **kwargs)
+        else:
+            cursor = coll.find(*args, **kwargs)
+            if sort:
+                cursor = cursor.sort(sort)
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+        if job is not None:
+            job.cursors.append(cursor)
+        return cursor
+
+    def read_cursor(self, coll, method, args, sort=None, limit=None, skip=None, **kwargs):
+        """Open a find/aggregate cursor, replaying the result cache when it is on."""
+        pipeline = (args[0] if args else kwargs.get('pipeline')) if method == 'aggregate' else None
+        target = pipeline_output(pipeline)
+        if target or not self.settings['result_cache']:
+            cursor = self.open_cursor(coll, method, args, sort, limit, skip, **kwargs)
+            if target:
+                self.result_cache.invalidate(self.current_conn, coll.database.name, target)
+            return cursor
+        try:
+            raw = coll.codec_options.document_class is RawBSONDocument
+            query = json_util.dumps([method, args, sort, limit, skip, kwargs, raw])
+        except TypeError:
+            return self.open_cursor(coll, method, args, sort, limit, skip, **kwargs)
+        key = (self.current_conn, coll.database.name, coll.name, query)
+        docs = self.result_cache.get(key)
+        if docs is not None:
+            return iter(docs)
+        if self.settings['result_cache_watch']:
+            self.result_cache.watch(self.current_conn, coll.database)
+        cursor = self.open_cursor(coll, method, args, sort, limit, skip, **kwargs)
+        return self.result_cache.record(key, {coll.name} | pipeline_collections(pipeline), cursor)
+
+    def show_results(self, cursor, columns=None):
+        """Print query results, a page at a time in the interactive shell.
+
+        The cursor stays open between pages; `it`/`next` fetch the next one.
+        """
+        page_size = self.settings['page_size']
+        if not self.interactive or page_size <= 0 or (self.job is not None and not (self.job.foreground and self.job.pageable)):
+            self.write_results(cursor, columns=columns)
+            return
+        self.close_pager()
+        self.pager_cursor = cursor
+        self.pager_docs = iter(cursor)
+        self.pager_columns = columns
+        self.next_page()
+
+    def next_page(self):
+        if self.pager_docs is None:
+            print("No open cursor.")
+            return
+        try:
+            self.write_results(itertools.islice(self.pager_docs, self.settings['page_size'] or None),
+                               columns=self.pager_columns)
+            # Peek one document to know whether another page exists
+            doc = next(self.pager_docs)
+        except StopIteration:
+            self.close_pager()
+            return
+        except pymongo.errors.OperationFailure as e:
+            # Typically CursorNotFound after the server's idle cursor timeout
+            self.close_pager()
+            print(f"Cursor is no longer available ({e}); run the query again.")
+            return
+        self.pager_docs = itertools.chain([doc], self.pager_docs)
+        print('Type "it" for more')
+
+    def close_pager(self):
+        cursor, self.pager_cursor, self.pager_docs = self.pager_cursor, None, None
+        if hasattr(cursor, 'close'):
+            cursor.close()
+
+    def keyset_plan(self, plan):
+        """Seek past the last _id of the previous page instead of skipping OFFSET rows.
+
+        Applies to find plans with LIMIT that are unordered or ordered by _id;
+        unordered ones get an _id order so pages are stable. LIMIT without
+        OFFSET is the first page, so its bookmark starts the chain.
+        Returns the plan and the (query, offset) bookmark under which the
+        page's last _id is recorded, or None when keyset pagination doesn't
+        apply.
+        """
+        if plan.method != 'find' or not plan.limit:
+            return plan, None
+        sort = plan.sort or [('_id', 1)]
+        if [field for field, _ in sort] != ['_id']:
+            return plan, None
+        query = (self.current_conn, self.db.name, plan.collection, json_util.dumps([plan.args, sort]))
+        offset = plan.skip or 0
+        plan = plan._replace(sort=sort)
+        last = self.keyset_bookmarks.get((query, offset)) if offset else None
+        if last is not None:
+            self.keyset_bookmarks.move_to_end((query, offset))
+            bound = {'_id': {'$gt' if sort[0][1] == 1 else '$lt': last}}
+            filter_doc = merge_conjunction([plan.args[0], bound]) if plan.args and plan.args[0] else bound
+            plan = plan._replace(args=(filter_doc,) + tuple(plan.args[1:]), skip=None)
+        return plan, (query, offset)
+
+    def record_bookmark(self, docs, query, position, limit):
+        """Yield a page of docs, remembering the last _id once the page is full."""
+        count, last = 0, None
+        for doc in docs:
+            count += 1
+            last = doc.get('_id') if isinstance(doc, dict) else None
+            yield doc
+        if count == limit and last is not None:
+            self.keyset_bookmarks[(query, position + limit)] = last
+            self.keyset_bookmarks.move_to_end((query, position + limit))
+            while len(self.keyset_bookmarks) > KEYSET_BOOKMARKS:
+                self.keyset_bookmarks.popitem(last=False)
+
+    def export_collection(self, collection, where, path):
+        """Export a collection as (compressed) NDJSON or BSON using parallel _id range scans.
+
+        Each worker streams its range into its own part file with the same
+        compression; the parts are then concatenated in _id order, which is
+        valid for NDJSON, gzip members and zstd frames alike.
+        """
+        filter_doc = {}
+        if where:
+            plan = self.translate(f"SELECT * FROM {collection} WHERE {where}")
+            if not plan:
+                return
+            filter_doc = plan.args[0]
+        coll = self.db[collection]
+        workers = max(self.settings['workers'], 1)
+        started = time.time()
+        filters = id_range_filters(filter_doc, compute_split_points(coll, filter_doc, workers))
+        part_paths = [f"{path}.part{i}" for i in range(len(filters))]
+
+        # .bson exports copy the server's bytes without decoding documents
+        writer, scan_coll = (write_bson, raw_collection(coll)) if is_bson_path(path) else (write_ndjson, coll)
+        job = self.job
+
+        def scan(range_filter, part_path):
+            # Run under the job, so its cursor is tagged and closed on cancel
+            self.local.job = job
+            try:
+                with open_compressed(part_path, name=path) as raw:
+                    out = io.TextIOWrapper(raw, encoding='utf-8')
+                    cursor = self.open_cursor(scan_coll, 'find', [range_filter])
+                    # No per-batch flushing: it would cost compression ratio
+                    count = writer(job.check(cursor) if job is not None else cursor, out, 0, self.encode)
+                    out.flush()
+                    out.detach()
+                return count
+            finally:
+                self.local.job = None
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                counts = list(pool.map(scan, filters, part_paths))
+            with open(path, 'wb') as dest:
+                for part_path in part_paths:
+                    with open(part_path, 'rb') as part:
+                        shutil.copyfileobj(part, dest)
+        finally:
+            for part_path in part_paths:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+        total = sum(counts)
+        elapsed = time.time() - started
+        rate = total / elapsed if elapsed > 0 else total
+        print(f"Exported {total} documents from {collection} to {path} "
+              f"in {elapsed:.2f}s ({rate:.0f} docs/s, {len(filters)} ranges)")
+
+    def watch_collection(self, collection, where):
+        """Print inserts, updates and deletes on a collection as they happen, until Ctrl-C.
+
+        The change stream is filtered on the server by the translated WHERE
+        clause. Its resume token is saved to RESUME_TOKEN_FILE, so watching
+        the same collection and filter again continues after the last
+        event seen (events of the last second may be shown twice).
+        """
+        filter_doc = {}
+        if where:
+            plan = self.translate(f"SELECT * FROM {collection} WHERE {where}")
+            if not plan:
+                return
+            filter_doc = plan.args[0]
+        path = os.path.expanduser(RESUME_TOKEN_FILE)
+        key = f"{self.current_conn}/{self.db.name}/{collection}/{json_util.dumps(filter_doc, sort_keys=True)}"
+        token = load_resume_tokens(path).get(key)
+        pipeline = change_stream_pipeline(filter_doc)
+        # Updates only carry the changed fields; the filter needs the whole document
+        options = {'full_document': 'updateLookup'} if filter_doc else {}
+        job = self.job
+        if job is not None:
+            options['comment'] = job.tag
+        coll = self.db[collection]
+        try:
+            stream = coll.watch(pipeline, start_after=token, max_await_time_ms=1000, **options)
+        except pymongo.errors.OperationFailure as e:
+            # 280/286: the saved position has already left the oplog
+            if token is None or e.code not in (280, 286):
+                raise
+            print(f"Saved position on {collection} is no longer available; watching from now.")
+            token = None
+            stream = coll.watch(pipeline, max_await_time_ms=1000, **options)
+        if job is not None:
+            job.cursors.append(stream)
+        print(f"{'Resuming' if token else 'Watching'} {collection} (Ctrl-C to stop).")
+        saved = time.monotonic()
+        try:
+            with stream:
+                while stream.alive:
+                    if job is not None and job.cancelled:
+                        raise JobCancelled()
+                    change = stream.try_next()
+                    if change is not None:
+                        print(self.encode({k: v for k, v in change.items() if k not in ('_id', 'ns')}))
+                    if time.monotonic() - saved >= RESUME_SAVE_INTERVAL and stream.resume_token is not None:
+                        save_resume_token(path, key, stream.resume_token)
+                        saved = time.monotonic()
+            if job is not None and job.cancelled:
+                raise JobCancelled()
+            print(f"Change stream on {collection} closed (collection dropped or renamed).")
+        finally:
+            if stream.resume_token is not None:
+                save_resume_token(path, key, stream.resume_token)
+
+    def import_file(self, collection, path):
+        """Load an NDJSON, JSON, CSV or BSON file (optionally .gz/.zst) into a collection.
+
+        Documents are read lazily, grouped into batch_size batches and sent
+        with unordered insert_many, keeping up to `workers` batches in flight.
+        """
+        name = path[:-3] if path.endswith('.gz') else path[:-4] if path.endswith('.zst') else path
+        reader = DOCUMENT_READERS.get(os.path.splitext(name)[1].lower())
+        if reader is None:
+            print(f"Unsupported import format: {path} (expected .ndjson, .jsonl, .json, .csv or .bson)")
+            return
+        coll = self.db[collection]
+        workers = max(self.settings['workers'], 1)
+        batch_size = self.settings['batch_size'] or 1000
+        job = self.job
+        # Tag the inserts so cancelling the job can killOp them
+        options = {'comment': job.tag} if job is not None else {}
+
+        def insert(batch):
+            if job is not None and job.cancelled:
+                return 0, []
+            try:
+                coll.insert_many(batch, ordered=False, **options)
+                # inserted_ids leaves out RawBSONDocuments, so count the batch
+                return len(batch), []
+            except pymongo.errors.BulkWriteError as e:
+                return e.details.get('nInserted', 0), e.details.get('writeErrors', [])
+
+        inserted = errors = 0
+        started = time.time()
+
+        def collect(pending, futures):
+            nonlocal inserted, errors
+            for future in sorted(futures, key=pending.get):
+                number = pending.pop(future)
+                count, write_errors = future.result()
+                inserted += count
+                errors += len(write_errors)
+                if write_errors:
+                    print(f"Batch {number}: {len(write_errors)} write errors "
+                          f"(first: {write_errors[0].get('errmsg')})")
+
+        with open_compressed(path, 'rb') as raw:
+            fh = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = {}  # future -> batch number
+                for number, batch in enumerate(iter_batches(reader(fh), batch_size), 1):
+                    if job is not None and job.cancelled:
+                        raise JobCancelled()
+                    if len(pending) >= workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(pending, done)
+                    pending[pool.submit(insert, batch)] = number
+                collect(pending, list(pending))
+        self.result_cache.invalidate(self.current_conn, self.db.name, collection)
+        elapsed = time.time() - started
+        rate = inserted / elapsed if elapsed > 0 else inserted
+        print(f"Imported {inserted} documents into {collection} from {path} "
+              f"in {elapsed:.2f}s ({rate:.0f} docs/s, {errors} write errors)")
+
+    @property
+    def variables(self):
+        return self.expander.variables
+
+    @property
+    def aliases(self):
+        return self.expander.aliases
+
+    def substitute_vars(self, text):
+        return self.expander.substitute_vars(text)
+
+    def start_job(self, command, foreground=True, pageable=True):
+        """Run a command on its own thread and register it in the job table."""
+        stream = sys.stdout.stream if isinstance(sys.stdout, JobOutput) else sys.stdout
+        job = Job(self.next_job_id, command, self.client, foreground, stream, pageable)
+        self.next_job_id += 1
+        self.jobs[job.id] = job
+        threading.Thread(target=self.run_job, args=(job,), daemon=True).start()
+        return job
+
+    def run_job(self, job):
+        self.local.job = job
+        try:
+            job.result = self.run_timed(job.command)
+            job.status = 'cancelled' if job.cancelled else 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.status = 'cancelled' if job.cancelled else 'failed'
+            if not job.cancelled:
+                self.report_error(f"Error: {e}")
+        finally:
+            self.local.job = None
+            job.finished = time.time()
+            job.done.set()
+
+    def wait_job(self, job):
+        """Wait for a foreground job; Ctrl-C cancels the job instead of leaving the shell."""
+        try:
+            while not job.done.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            self.cancel_job(job)
+            if not job.done.wait(CANCEL_GRACE):
+                job.to_background()
+                print(f"\n[{job.id}] still stopping in the background.")
+                return None
+            print(f"\n[{job.id}] cancelled.")
+        self.jobs.pop(job.id, None)
+        return job.result
+
+    def cancel_job(self, job):
+        """Kill a job's server-side operations and close its cursors."""
+        job.cancelled = True
+        if job.client is not None:
+            try:
+                ops = job.client.admin.aggregate([
+                    {'$currentOp': {}},
+                    {'$match': {'$or': [{'command.comment': job.tag},
+                                        {'cursor.originatingCommand.comment': job.tag}]}},
+                ])
+                for op in ops:
+                    job.client.admin.command('killOp', op=op['opid'])
+            except pymongo.errors.PyMongoError:
+                pass  # e.g. no inprog/killop privilege; closing the cursors still stops fetching
+        for cursor in list(job.cursors):
+            try:
+                cursor.close()
+            except pymongo.errors.PyMongoError:
+                pass
+
+    def is_read(self, statement):
+        """is_read_statement on the command an alias or $variables expand to."""
+        return is_read_statement(self.expander.expand(statement))
+
+    def run_parallel(self, statements):
+        """Run independent read statements concurrently over the pooled client.
+
+        Each statement runs as its own job with buffered output; results are
+        printed in statement order, each as soon as it and those before it
+        are done, so the block takes about as long as its slowest query.
+        """
+        for statement in statements:
+            if not self.is_read(statement):
+                print(f"parallel only runs read statements: {statement}")
+                return
+        # Not pageable: the jobs share one pager and would replace each other's cursor
+        jobs = [self.start_job(statement, foreground=False, pageable=False) for statement in statements]
+        try:
+            for job in jobs:
+                job.announced = True
+                job.to_foreground()
+                while not job.done.wait(0.1):
+                    pass
+                self.jobs.pop(job.id, None)
+        except KeyboardInterrupt:
+            pending = [job for job in jobs if not job.done.is_set()]
+            for job in pending:
+                self.cancel_job(job)
+            for job in pending:
+                job.done.wait(CANCEL_GRACE)
+            for job in jobs:
+                job.announced = True
+                if job.done.is_set():
+                    self.jobs.pop(job.id, None)
+                else:
+                    job.to_background()
+            print(f"\nCancelled {len(pending)} parallel statement(s).")
+
+    def report_jobs(self):
+        """Announce background jobs that finished since the last prompt."""
+        for job in self.jobs.values():
+            if job.done.is_set() and not job.announced:
+                job.announced = True
+                print(f"[{job.id}] {job.status}  {job.command}")
+
+    def job_command(self, cmd_line):
+        """Handle jobs, fg [id] and kill <id>; returns False when the session should end."""
+        if cmd_line == 'jobs':
+            if not self.jobs:
+                print("No jobs.")
+            for job in self.jobs.values():
+                print(f"[{job.id}] {job.status:<9} {(job.finished or time.time()) - job.started:8.1f}s  {job.command}")
+            return
+        parts = cmd_line.split()
+        try:
+            job = self.jobs[int(parts[1])] if len(parts) > 1 else next(reversed(self.jobs.values()))
+        except (ValueError, KeyError, StopIteration):
+            print("No such job.")
+            return
+        if parts[0] == 'fg':
+            job.announced = True
+            print(job.command)
+            job.to_foreground()
+            return self.wait_job(job)
+        if job.done.is_set():
+            # Nothing left to stop; drop the job and its buffered output
+            self.jobs.pop(job.id)
+            print(f"[{job.id}] removed.")
+        else:
+            self.cancel_job(job)
+            print(f"[{job.id}] cancelling.")
+
+    @contextlib.contextmanager
+    def job_output(self):
+        """Route each job thread's prints to its job while the block runs."""
+        sys.stdout = JobOutput(sys.stdout, self.local)
+        try:
+            yield
+        finally:
+            sys.stdout = sys.stdout.stream
+
+    def run_script(self, lines, parallel=False):
+        """Run commands without the REPL (-c, -f and stdin modes).
+
+        Lines are handled like REPL input; `#` and `//` lines are comments and a
+        `parallel {` block may span several lines. With parallel=True,
+        consecutive read statements are batched into parallel blocks, with
+        every other command acting as a barrier. Errors go to stderr, and any
+        failed command makes the run exit with status 1.
+        """
+        batch = []
+
+        def flush():
+            if len(batch) > 1:
+                self.run_parallel(batch)
+            elif batch:
+                self.run_timed(batch[0])
+            batch.clear()
+
+        with self.job_output():
+            block = None
+            for line in lines:
+                line = line.strip()
+                if block is not None:
+                    block.append(line)
+                    if not line.endswith('}'):
+                        continue
+                    line, block = ' '.join(block), None
+                if not line or line.startswith(('#', '//')):
+                    continue
+                statements = split_statements(line)
+                if statements and re.match(r'parallel\s*\{', statements[-1]) and not statements[-1].endswith('}'):
+                    block = [line]
+                    continue
+                for cmd_line in statements:
+                    m = re.match(r'parallel\s*\{(.*)\}$', cmd_line, re.DOTALL)
+                    if m:
+                        flush()
+                        self.run_parallel(split_statements(m.group(1)))
+                        continue
+                    if parallel and self.is_read(cmd_line):
+                        batch.append(cmd_line)
+                        continue
+                    flush()
+                    if self.run_timed(cmd_line) is False:
+                        return
+            flush()
+
+    def run_timed(self, cmd_line):
+        """Run one command on this thread, reporting its phases when timing is on."""
+        self.timer = PhaseTimer() if self.settings['timing'] else None
+        try:
+            return self.run_command(cmd_line)
+        finally:
+            if self.timer is not None and self.timer.phases:
+                print(self.timer.report())
+            self.timer = None
+
+    def run_session(self):
+        # prompt_toolkit is only needed interactively; -c/-f/stdin runs skip the import
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.history import FileHistory
+        session = PromptSession(history=FileHistory('mongo_cli_history.txt'))
+        self.interactive = True
+        # Jobs print through their own thread; route each thread's output to its job
+        with self.job_output():
+            while True:
+                try:
+                    self.report_jobs()
+                    # Show connection and DB in prompt
+                    prompt_str = f"[{self.current_conn}/{self.db.name if self.db is not None else '?'}] mongo> "
+                    line = session.prompt(prompt_str).strip()
+                    if not line:
+                        continue
+                    # Multiple commands separated by ; outside quotes and brackets
+                    commands = split_statements(line)
+                    for cmd_line in commands:
+                        # Concurrent block: parallel { stmt; stmt; ... }
+                        m = re.match(r'parallel\s*\{(.*)\}$', cmd_line, re.DOTALL)
+                        if m:
+                            self.run_parallel(split_statements(m.group(1)))
+                            continue
+                        if cmd_line == 'jobs' or re.match(r'(fg(\s+\d+)?|kill\s+\d+)$', cmd_line):
+                            result = self.job_command(cmd_line)
+                        elif cmd_line.endswith('&') and not cmd_line.endswith('&&'):
+                            # Background job: cmd &
+                            job = self.start_job(cmd_line[:-1].strip(), foreground=False)
+                            print(f"[{job.id}] {job.command}")
+                            continue
+                        else:
+                            result = self.wait_job(self.start_job(cmd_line))
+                        if result is False:
+                            return
+                except KeyboardInterrupt:
+                    print("\nBye!")
+                    break
+                except Exception as e:
+                    print(f"Error: {e}")
+
+    def run_command(self, cmd_line):
+        """Expand and dispatch one command; returns False when the session should end."""
+        # Alias expansion and variable substitution
+        cmd_line = self.expander.expand(cmd_line)
+        # Command substitution
+        cmd_line = self.substitute_commands(cmd_line)
+        #clear screen
+        if cmd_line.lower() == 'clear':
+            os.system('cls' if os.name == 'nt' else 'clear')
+            return
+        # Handle exit
+
+        if cmd_line.lower() in ['exit', 'quit']:
+            print("Bye!")
+            return False
+        # Handle connection switching with 'switch'
+        if cmd_line.startswith('switch '):
+            conn = cmd_line.split(' ', 1)[1].strip()
+            if conn in self.configs:
+                self.connect(conn)
+                print(f"Switched to: {conn}")
+            else:
+                print(f"Connection '{conn}' not found.")
+            return
+        # Handle 'use' for connection or database
+        if cmd_line.startswith('use '):
+            name = cmd_line.split(' ', 1)[1].strip()
+            # First, check if it's a connection name
+            if name in self.configs:
+                self.connect(name)
+                print(f"Switched to connection: {name}")
+            else:
+                # Try to switch database within the current connection
+                if self.client:
+                    try:
+                        self.db = self.client[name]
+                        print(f"Switched to database: {name}")
+                    except Exception:
+                        print(f"No database by the name '{name}' in the current connection.")
+                else:
+                    print(f"No connection or database by the name '{name}'.")
+            return
+        # Show connections
+        if cmd_line == 'show connections':
+            print("Configured connections:")
+            for conn in self.configs:
+                marker = " (current)" if conn == self.current_conn else ""
+                if conn in self.clients:
+                    marker += " (connected)"
+                print(f"  {conn}{marker}")
+            return
+        # Show variables
+        if cmd_line == 'show vars':
+            print("Session variables:")
+            for k, v in self.variables.items():
+                print(f"  {k} = {v}")
+            return
+        # Show sampled fields of a collection
+        if cmd_line.startswith('show schema '):
+            collection = cmd_line[12:].strip()
+            print(f"Fields of {collection}:")
+            for field in self.collection_fields(collection):
+                print(f"  {field}")
+            return
+        # Re-sample collection fields: refresh schema [collection]
+        if cmd_line == 'refresh schema' or cmd_line.startswith('refresh schema '):
+            collection = cmd_line[14:].strip() or None
+            self.schema_cache.refresh(collection)
+            print(f"Schema cache cleared for {collection or 'all collections'}.")
+            return
+        # Show settings
+        if cmd_line == 'show settings':
+            print("Settings:")
+            for k, v in self.settings.items():
+                print(f"  {k} = {v}")
+            return
+        # Change a setting
+        if cmd_line.startswith('setopt '):
+            parts = cmd_line[7:].split('=', 1)
+            if len(parts) == 2:
+                k, v = parts[0].strip(), parts[1].strip()
+                if k not in self.settings:
+                    print(f"Unknown setting '{k}'.")
+                    return
+                try:
+                    self.settings[k] = coerce_setting(k, v)
+                    self.apply_settings()
+                    print(f"Setting {k} = {self.settings[k]}")
+                except ValueError as e:
+                    print(f"Invalid value for {k}: {e}")
+            return
+        # Output format shortcut: format json|pretty|compact|ndjson|bson|table|csv|tsv|parquet|arrow
+        if cmd_line.startswith('format '):
+            try:
+                self.settings['format'] = coerce_setting('format', cmd_line[7:])
+                print(f"Output format: {self.settings['format']}")
+            except ValueError as e:
+                print(f"Invalid format: {e}")
+            return
+        # Set variable
+        if cmd_line.startswith('set '):
+            parts = cmd_line[4:].split('=', 1)
+            if len(parts) == 2:
+                k, v = parts[0].strip(), parts[1].strip()
+                self.expander.set_variable(k, v)
+                print(f"Set {k} = {v}")
+            return
+        # Alias definition
+        if cmd_line.startswith('alias '):
+            parts = cmd_line[6:].split('=', 1)
+            if len(parts) == 2:
+                k, v = parts[0].strip(), parts[1].strip()
+                self.expander.set_alias(k, v)
+                print(f"Alias {k} = {v}")
+            return
+        # Parallel export: export <collection> [WHERE ...] TO <file>
+        if cmd_line.lower().startswith('export '):
+            m = re.match(r"export\s+(\w+)(?:\s+WHERE\s+(.+?))?\s+TO\s+(\S+)$", cmd_line, re.IGNORECASE)
+            if m:
+                self.export_collection(m.group(1), m.group(2), m.group(3))
+            else:
+                print("Usage: export <collection> [WHERE ...] TO <file.ndjson|.bson[.gz|.zst]>")
+            return
+        # Change stream: watch <collection> [WHERE ...]
+        if cmd_line.lower().startswith('watch '):
+            m = re.match(r"watch\s+(\w+)(?:\s+WHERE\s+(.+))?$", cmd_line, re.IGNORECASE)
+            if m:
+                self.watch_collection(m.group(1), m.group(2))
+            else:
+                print("Usage: watch <collection> [WHERE ...]")
+            return
+        # Batched import: import <collection> FROM <file>
+        if cmd_line.lower().startswith('import '):
+            m = re.match(r"import\s+(\w+)\s+FROM\s+(\S+)$", cmd_line, re.IGNORECASE)
+            if m:
+                self.import_file(m.group(1), m.group(2))
             else:
-                uri = f"mongodb://{cfg['host']}:{cfg['port']}/"
-                if cfg.get('username') and cfg.get('password'):
-                    uri = f"mongodb://{cfg['username']}:{cfg['password']}@{cfg['host']}:{cfg['port']}/"
-                self.client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=5000)
-            # Attempt to fetch server info to trigger connection
-            self.client.server_info()
-            self.db = self.client[cfg['database']]
-            self.current_conn = conn_name
-        except Exception as e:
-            print(f"Connection to '{conn_name}' failed: {e}")
-            self.client = None
-            self.db = None
-            self.current_conn = None
+                print("Usage: import <collection> FROM <file.ndjson|.json|.csv|.bson>")
+            return
+        # Next page of the last paged result
+        if cmd_line in ('it', 'next'):
+            self.next_page()
+            return
+        # Result cache: cache stats | cache clear
+        if cmd_line in ('cache stats', 'cache clear'):
+            if cmd_line == 'cache clear':
+                self.result_cache.clear()
+                print("Result cache cleared.")
+            else:
+                state = 'on' if self.settings['result_cache'] else 'off'
+                print(f"Result cache ({state}): {self.result_cache.stats()}")
+            return
+        # Indexes: show indexes <coll>, create [unique] index [name] on <coll> (cols), drop index <name> on <coll>
+        if cmd_line.startswith('show indexes '):
+            self.show_indexes(cmd_line[13:].strip())
+            return
+        if re.match(r"(create|drop)\s+(unique\s+)?index\b", cmd_line, re.IGNORECASE):
+            create = re.match(r"create\s+(unique\s+)?index\s+(?:(\w+)\s+)?on\s+(\w+)\s*\((.+)\)$",
+                              cmd_line, re.IGNORECASE)
+            drop = re.match(r"drop\s+index\s+(\S+)\s+on\s+(\w+)$", cmd_line, re.IGNORECASE)
+            if create:
+                self.create_index(create.group(3), create.group(4), create.group(2), bool(create.group(1)))
+            elif drop:
+                self.db[drop.group(2)].drop_index(drop.group(1))
+                print(f"Dropped index {drop.group(1)} on {drop.group(2)}.")
+            else:
+                print("Usage: create [unique] index [name] on <collection> (field [ASC|DESC], ...)\n"
+                      "       drop index <name> on <collection>")
+            return
+        # Index suggestions: advise <find|aggregate|SELECT>, or advise profile [n] from system.profile
+        if cmd_line.lower() == 'advise profile' or cmd_line.lower().startswith('advise profile '):
+            limit = cmd_line[15:].strip()
+            self.advise_profile(int(limit) if limit.isdigit() else 10)
+            return
+        if cmd_line.lower().startswith('advise '):
+            self.advise(cmd_line[7:])
+            return
+        # Query plan summary: explain <find|aggregate|SELECT>
+        if cmd_line.lower().startswith('explain '):
+            self.explain(cmd_line[8:])
+            return
+        # Per-phase timing report: timing on|off
+        if cmd_line.lower() in ('timing on', 'timing off'):
+            self.settings['timing'] = cmd_line.lower().endswith('on')
+            print(f"Timing: {'on' if self.settings['timing'] else 'off'}")
+            return
+        # Handle piping and redirection
+        if '|' in cmd_line or '>' in cmd_line:
+            self.handle_pipe_redirect(cmd_line)
+            return
+        # Execute MongoDB command
+        self.execute_command(cmd_line)
 
-    def substitute_vars(self, text):
-        for k, v in self.variables.items():
-            text = text.replace(f"${k}", str(v))
-        return text
+    def handle_pipe_redirect(self, line):
+        """Run a query whose output goes to a file and/or a chain of shell commands.
 
-    def run_session(self):
-        session = PromptSession(history=FileHistory('mongo_cli_history.txt'))
-        while True:
-            try:
-                # Show connection and DB in prompt
-                prompt_str = f"[{self.current_conn}/{self.db.name if self.db is not None else '?'}] mongo> "
-                line = session.prompt(prompt_str).strip()
-                if not line:
-                    continue
-                # Multiple commands separated by ;
-                commands = [cmd.strip() for cmd in line.split(';') if cmd.strip()]
-                for cmd_line in commands:
-                    # Alias expansion
-                    for alias, cmd in self.aliases.items():
-                        if cmd_line.lower().startswith(alias.lower()):
-                            extra = cmd_line[len(alias):].strip()
-                            cmd_line = f"{cmd} {extra}".strip()
-                    # Variable substitution
-                    cmd_line = self.substitute_vars(cmd_line)
-                    # Command substitution
-                    cmd_line = self.substitute_commands(cmd_line)
-                    #clear screen
-                    if cmd_line.lower() == 'clear':
-                        os.system('cls' if os.name == 'nt' else 'clear')
-                        continue
-                    # Handle exit
+        Supported forms: `query > file`, `query >> file`, `query | cmd`,
+        `query | cmd1 | cmd2 ... [> file | >> file]`. Documents are streamed
+        from the cursor straight into the file or the first process's stdin;
+        a slow consumer blocks the writer on the full pipe, so memory stays
+        bounded by the cursor batch size.
+        """
+        import shlex
+        import subprocess
 
-                    if cmd_line.lower() in ['exit', 'quit']:
-                        print("Bye!")
-                        return
-                    # Handle connection switching with 'switch'
-                    if cmd_line.startswith('switch '):
-                        conn = cmd_line.split(' ', 1)[1].strip()
-                        if conn in self.configs:
-                            self.connect(conn)
-                            print(f"Switched to: {conn}")
-                        else:
-                            print(f"Connection '{conn}' not found.")
-                        continue
-                    # Handle 'use' for connection or database
-                    if cmd_line.startswith('use '):
-                        name = cmd_line.split(' ', 1)[1].strip()
-                        # First, check if it's a connection name
-                        if name in self.configs:
-                            self.connect(name)
-                            print(f"Switched to connection: {name}")
-                        else:
-                            # Try to switch database within the current connection
-                            if self.client:
-                                try:
-                                    self.db = self.client[name]
-                                    print(f"Switched to database: {name}")
-                                except Exception:
-                                    print(f"No database by the name '{name}' in the current connection.")
-                            else:
-                                print(f"No connection or database by the name '{name}'.")
-                        continue
-                    # Show connections
-                    if cmd_line == 'show connections':
-                        print("Configured connections:")
-                        for conn in self.configs:
-                            marker = " (current)" if conn == self.current_conn else ""
-                            print(f"  {conn}{marker}")
-                        continue
-                    # Show variables
-                    if cmd_line == 'show vars':
-                        print("Session variables:")
-                        for k, v in self.variables.items():
-                            print(f"  {k} = {v}")
-                        continue
-                    # Set variable
-                    if cmd_line.startswith('set '):
-                        parts = cmd_line[4:].split('=', 1)
-                        if len(parts) == 2:
-                            k, v = parts[0].strip(), parts[1].strip()
-                            self.variables[k] = v
-                            print(f"Set {k} = {v}")
-                        continue
-                    # Alias definition
-                    if cmd_line.startswith('alias '):
-                        parts = cmd_line[6:].split('=', 1)
-                        if len(parts) == 2:
-                            k, v = parts[0].strip(), parts[1].strip()
-                            self.aliases[k] = v
-                            print(f"Alias {k} = {v}")
-                        continue
-                    # Handle piping and redirection
-                    if '|' in cmd_line or '>' in cmd_line:
-                        self.handle_pipe_redirect(cmd_line)
-                        continue
-                    # Execute MongoDB command
-                    self.execute_command(cmd_line)
-            except KeyboardInterrupt:
-                print("\nBye!")
-                break
-            except Exception as e:
-                print(f"Error: {e}")
+        statements = lex_command_line(line, split=False)
+        if not statements:
+            return
+        stages, filename = statements[0].stages, statements[0].target
+        mode = 'a' if statements[0].append else 'w'
 
-    def handle_pipe_redirect(self, line):
-        import re
-
-        def is_outside_quotes_and_parens(s, idx):
-            in_single = in_double = False
-            paren_level = 0
-            for i, c in enumerate(s):
-                if c == "'" and not in_double:
-                    in_single = not in_single
-                elif c == '"' and not in_single:
-                    in_double = not in_double
-                elif c == '(' and not in_single and not in_double:
-                    paren_level += 1
-                elif c == ')' and not in_single and not in_double:
-                    paren_level = max(paren_level - 1, 0)
-                if i == idx:
-                    return not in_single and not in_double and paren_level == 0
-            return True
-
-        # Find the last > that is outside quotes and parentheses
-        gt_indices = [m.start() for m in re.finditer('>', line)]
-        split_idx = None
-        for idx in reversed(gt_indices):
-            if is_outside_quotes_and_parens(line, idx):
-                split_idx = idx
-                break
+        if filename is None and len(stages) == 1:
+            # Only comparison operators, e.g. SELECT ... WHERE age > 21
+            self.execute_command(line)
+            return
+        if not all(stages) or filename == '':
+            self.report_error("Invalid pipe or redirect.")
+            return
 
-        if split_idx is not None:
-            cmd = line[:split_idx].strip()
-            filename = line[split_idx+1:].strip()
-            result = self.execute_command(cmd, return_result=True, suppress_output=True)
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(json_util.dumps(result, indent=2, ensure_ascii=False))
-            print(f"Output written to {filename}")
+        cmd, pipe_cmds = stages[0], stages[1:]
+        if cmd.upper().startswith('SELECT') and not self.translate(cmd):
+            # Don't create or truncate the target for a statement that can't run
+            return
+        # The target's extension picks the format, e.g. `> dump.bson`, `> rows.parquet`
+        output_format = REDIRECT_FORMATS.get(os.path.splitext(filename)[1].lower()) if filename and not pipe_cmds else None
+        if (output_format or self.settings['format']) in ('parquet', 'arrow'):
+            try:
+                import_pyarrow()
+            except RuntimeError as e:
+                self.report_error(e)
+                return
+        self.local.failed = False
+        if not pipe_cmds:
+            with open(filename, mode, encoding='utf-8') as f:
+                self.execute_command(cmd, out=f, output_format=output_format)
+            if not self.local.failed:
+                print(f"Output written to {filename}")
             return
 
-        # Fallback to pipe handling
-        if '|' in line:
-            cmd, pipe_cmd = line.split('|', 1)
-            cmd = cmd.strip()
-            pipe_cmd = pipe_cmd.strip()
-            result = self.execute_command(cmd, return_result=True, suppress_output=True)
-            proc = subprocess.Popen(shlex.split(pipe_cmd), stdin=subprocess.PIPE)
-            proc.communicate(input=json_util.dumps(result, indent=2, ensure_ascii=False).encode('utf-8'))
+        # Chain the shell commands: each process reads the previous one's stdout
+        dest = open(filename, mode, encoding='utf-8') if filename else None
+        procs = []
+        try:
+            stdin = subprocess.PIPE
+            try:
+                for i, pipe_cmd in enumerate(pipe_cmds):
+                    is_last = i == len(pipe_cmds) - 1
+                    proc = subprocess.Popen(
+                        shlex.split(pipe_cmd), stdin=stdin,
+                        stdout=(dest if is_last else subprocess.PIPE),
+                    )
+                    if procs:
+                        # Let the upstream process see SIGPIPE if this one exits early
+                        procs[-1].stdout.close()
+                    procs.append(proc)
+                    stdin = proc.stdout
+            except OSError as e:
+                # A later stage failed to start: give the earlier ones EOF so waiting on them returns
+                if procs:
+                    procs[0].stdin.close()
+                for proc in procs:
+                    proc.terminate()
+                self.report_error(f"Pipe command failed: {e}")
+                return
+            writer = io.TextIOWrapper(procs[0].stdin, encoding='utf-8')
+            try:
+                self.execute_command(cmd, out=writer)
+            except BrokenPipeError:
+                # The consumer stopped reading (e.g. `| head`); stop fetching
+                pass
+            finally:
+                try:
+                    writer.close()
+                except BrokenPipeError:
+                    pass
+        finally:
+            for proc in procs:
+                proc.wait()
+            if dest is not None:
+                dest.close()
+        if filename and not self.local.failed:
+            print(f"Output written to {filename}")
+
+    def execute_command(self, command, return_result=False, suppress_output=False, out=None, output_format=None):
+        """Run a single query or db command.
 
-    def execute_command(self, command, return_result=False, suppress_output=False):
+        When out is given, results are streamed into it (a file or pipe)
+        instead of being printed, and status messages are suppressed.
+        output_format overrides the format setting; for bson, cursors return
+        RawBSONDocuments that are written out without being decoded.
+        """
+        if out is not None:
+            suppress_output = True
+        output_format = output_format or self.settings['format']
         # SQL translation
         if command.strip().upper().startswith("SELECT"):
-            sql_result = sql_to_mongo(command)
-            if sql_result:
-                collection, method, args, sort, limit = sql_result
-                coll = self.db[collection]
-                result = None
-                if method == 'find':
-                    cursor = coll.find(*args)
-                    if sort:
-                        cursor = cursor.sort(sort)
-                    if limit:
-                        cursor = cursor.limit(limit)
-                    result = list(cursor)
-                    if not suppress_output:
-                        print(json_util.dumps(result, indent=2, ensure_ascii=False))
-                    if return_result:
-                        return result
-                if method == 'aggregate':
-                    cursor = coll.aggregate(*args)
+            with self.timed('parse/translate'):
+                plan = self.translate(command)
+                if plan and plan.method == 'aggregate':
+                    plan = self.optimize_plan(plan)
+                if plan:
+                    plan, bookmark = self.keyset_plan(plan)
+            if plan:
+                coll = self.db[plan.collection]
+                if output_format == 'bson':
+                    coll = raw_collection(coll)
+                if plan.method in COUNT_METHODS:
+                    # Counted on the server; only the number comes back
+                    kwargs = {'comment': self.job.tag} if self.job is not None else {}
+                    with self.timed('server'):
+                        cursor = [{plan.output: getattr(coll, plan.method)(*plan.args, **kwargs)}]
+                    columns = [plan.output]
+                else:
+                    with self.timed('open cursor'):
+                        cursor = self.read_cursor(coll, plan.method, plan.args, plan.sort, plan.limit, plan.skip)
+                    if plan.empty is not None:
+                        cursor = default_rows(cursor, plan.empty)
+                    if bookmark is not None:
+                        cursor = self.record_bookmark(cursor, *bookmark, plan.limit)
+                    columns = result_columns(plan.method, plan.args)
+                if out is not None:
+                    self.write_results(cursor, out, output_format, columns)
+                    return
+                if return_result:
                     result = list(cursor)
                     if not suppress_output:
-                        print(json_util.dumps(result, indent=2, ensure_ascii=False))
-                    if return_result:
-                        return result
-                return
+                        self.write_results(result, columns=columns)
+                    return result
+                if not suppress_output:
+                    self.show_results(cursor, columns)
+            # Unsupported SQL was reported by translate
+            return
         # Handle db command
         if command.strip() == 'db':
+            if out is not None:
+                out.write(self.db.name + '\n')
             if not suppress_output:
                 print(self.db.name)
             if return_result:
@@ -263,68 +2660,59 @@ class MongoCLI:
         # Handle find, insert, update, delete
         try:
             if command.startswith('db.'):
-                # Parse collection and method
-                rest = command[3:]
-                if '.' not in rest:
-                    if not suppress_output:
-                        print("Invalid command.")
-                    return
-                collection, rest = rest.split('.', 1)
-                if '(' not in rest or not rest.endswith(')'):
-                    if not suppress_output:
-                        print("Invalid command.")
+                try:
+                    with self.timed('parse'):
+                        collection, method, args, kwargs = parse_db_command(command)
+                        args, kwargs = prepare_method_args(method, args, kwargs)
+                except ValueError as e:
+                    self.report_error(e, show=out is not None or not suppress_output)
                     return
-                method, argstr = rest.split('(', 1)
-                argstr = argstr[:-1]  # Remove trailing ')'
-                args = []
-                if argstr.strip():
-                    # Try to parse as JSON or Python dict
-                    try:
-                        args = [json.loads(argstr)]
-                    except Exception:
-                        try:
-                            args = [eval(argstr)]
-                        except Exception:
-                            if not suppress_output:
-                                print("Invalid argument format.")
-                            return
                 coll = self.db[collection]
-                result = None
-                if method == 'find':
-                    cursor = coll.find(*args)
-                    result = list(cursor)
-                    if not suppress_output:
-                        print(json_util.dumps(result, indent=2, ensure_ascii=False))
-                elif method == 'insert_one':
-                    result = coll.insert_one(*args)
-                    if not suppress_output:
-                        print(f"Inserted: {result.inserted_id}")
-                    result = {"inserted_id": str(result.inserted_id)}
-                elif method == 'delete_one':
-                    result = coll.delete_one(*args)
-                    if not suppress_output:
-                        print(f"Deleted: {result.deleted_count}")
-                    result = {"deleted_count": result.deleted_count}
-                elif method == 'update_one':
-                    result = coll.update_one(*args)
-                    if not suppress_output:
-                        print(f"Matched: {result.matched_count}, Modified: {result.modified_count}")
-                    result = {"matched_count": result.matched_count, "modified_count": result.modified_count}
-                else:
-                    if not suppress_output:
-                        print("Unsupported method.")
+                summarize = COLLECTION_METHODS[method]
+                if summarize is None:
+                    if output_format == 'bson':
+                        coll = raw_collection(coll)
+                    with self.timed('open cursor'):
+                        cursor = self.read_cursor(coll, method, args, **kwargs)
+                    columns = result_columns(method, args)
+                    if out is not None:
+                        self.write_results(cursor, out, output_format, columns)
+                        return
+                    result = None
+                    if return_result:
+                        result = list(cursor)
+                        if not suppress_output:
+                            self.write_results(result, columns=columns)
+                    elif not suppress_output:
+                        self.show_results(cursor, columns)
+                    return result
+                if self.job is not None:
+                    kwargs.setdefault('comment', self.job.tag)
+                with self.timed('server'):
+                    response = getattr(coll, method)(*args, **kwargs)
+                if method not in READ_METHODS:
+                    self.result_cache.invalidate(self.current_conn, self.db.name, collection)
+                result, message = summarize(response)
+                if not suppress_output:
+                    print(message)
+                if out is not None and result is not None and output_format != 'bson':
+                    out.write(json_util.dumps(result, indent=2, ensure_ascii=False) + '\n')
                 if return_result:
                     return result
             else:
-                if not suppress_output:
-                    print("Unknown command.")
+                self.report_error("Unknown command.", show=out is not None or not suppress_output)
+        except (BrokenPipeError, JobCancelled):
+            raise
         except Exception as e:
-            if not suppress_output:
-                print(f"MongoDB error: {e}")
+            if self.job is not None and self.job.cancelled:
+                # killOp or a closed cursor surfaces as an error in the job's thread
+                raise JobCancelled() from e
+            self.report_error(f"MongoDB error: {e}", show=out is not None or not suppress_output)
 
     def substitute_commands(self, text):
         # Find all backtick-enclosed commands and replace with their output
         def repl(match):
+            import subprocess
             cmd = match.group(1)
             try:
                 output = subprocess.check_output(cmd, shell=True, text=True)
@@ -334,362 +2722,1064 @@ class MongoCLI:
         # Replace all `...` with output
         return re.sub(r'`([^`]+)`', repl, text)
 
-def sql_to_mongo(sql):
-    # Extended regex to capture JOIN
-    join_match = re.match(
-        r"SELECT\s+(.+)\s+FROM\s+(\w+)(?:\s+(\w+))?\s+JOIN\s+(\w+)(?:\s+(\w+))?\s+ON\s+([\w\.]+)\s*=\s*([\w\.]+)(?:\s+WHERE\s+(.+?))?(?:\s+ORDER\s+BY\s+([\w\.]+)(?:\s+(ASC|DESC))?)?(?:\s+LIMIT\s+(\d+))?$",
-        sql, re.IGNORECASE
-    )
-    if join_match:
-        fields = join_match.group(1).replace(' ', '').split(',')
-        left_coll = join_match.group(2)
-        left_alias = join_match.group(3) or left_coll
-        right_coll = join_match.group(4)
-        right_alias = join_match.group(5) or right_coll
-        left_key = join_match.group(6)
-        right_key = join_match.group(7)
-        where_clause = join_match.group(8)
-        order_by_field = join_match.group(9)
-        order_by_dir = join_match.group(10)
-        limit_val = join_match.group(11)
-        print("join detected")
-        # Build $lookup
-        lookup_stage = {
-            "$lookup": {
-                "from": right_coll,
-                "localField": left_key.split('.')[-1],
-                "foreignField": right_key.split('.')[-1],
-                "as": right_alias
-            }
-        }
-        # Use $unwind with preserveNullAndEmptyArrays: False for inner join
-        unwind_stage = {"$unwind": {"path": f"${right_alias}", "preserveNullAndEmptyArrays": False}}
-
-        # Build $project
-        project = {}
-
-        # Dynamically expand a.* and b.* using find_one()
-        left_fields = []
-        right_fields = []
-        if len(fields) == 1 and fields[0] == '*':
-            project = None
-        else:
-            from pymongo import MongoClient
-            left_doc = None
-            right_doc = None
-            try:
-                left_doc = cli.db[left_coll].find_one() if hasattr(cli, 'db') else None
-            except Exception:
-                pass
+def is_sql_comparison(line, idx, operand):
+    """Return True if the > at line[idx] is a SQL comparison rather than a redirect.
+
+    `SELECT ... WHERE age > 21` must not write to a file named 21, nor
+    `WHERE age > score` to a file named score. For SQL statements the text
+    after > only counts as a redirect target when it is a single token
+    that is not a literal, and the statement before the > is complete on
+    its own.
+    """
+    if not line.strip().upper().startswith('SELECT'):
+        return False
+    if line[idx+1:idx+2] == '=' or line[idx-1:idx] == '<':
+        return True
+    if (not operand or len(operand.split()) > 1 or
+            re.fullmatch(r"-?\d+(\.\d+)?|'.*'|\".*\"|true|false|null", operand, re.IGNORECASE) is not None):
+        return True
+    try:
+        SQLParser(line[:idx]).parse()
+    except SQLSyntaxError:
+        return True
+    return False
+
+# Quoted strings (an unterminated one runs to the end) or a character that
+# structures a command line; everything in between is skipped
+COMMAND_TOKEN_RE = re.compile(r"""'(?:[^'\\]|\\.)*(?:'|$)|"(?:[^"\\]|\\.)*(?:"|$)|[()\[\]{};|>]""", re.DOTALL)
+
+# One statement of a command line: query | cmd | cmd > target (append for >>)
+Statement = namedtuple('Statement', 'text stages target append')
+
+def lex_command_line(line, split=True):
+    """Split a command line into statements, pipe stages and redirect targets in one pass.
+
+    `;` (only when split is set), `|` and `>` count only outside quotes,
+    parentheses, brackets and braces, so JSON, regexes and SQL strings
+    may contain them. The last `>` or `>>` of a statement's last stage
+    starts its redirect target, unless it is a comparison of a SELECT
+    (see is_sql_comparison). Empty statements are dropped.
+    """
+    statements = []
+    depth = 0
+    start = 0
+    cuts = []  # positions of top-level | in the current statement
+    redirect = None  # position of the last top-level > after the last |
+
+    def finish(end):
+        bounds = [start] + [c + 1 for c in cuts]
+        ends = cuts + [end]
+        stages = [line[a:b] for a, b in zip(bounds, ends)]
+        target, append = None, False
+        if redirect is not None:
+            last = stages[-1]
+            idx = redirect - bounds[-1]
+            op_start = idx - 1 if idx > 0 and last[idx - 1] == '>' else idx
+            operand = last[idx + 1:].strip()
+            if len(stages) > 1 or not is_sql_comparison(last, op_start, operand):
+                target, append = operand, op_start < idx
+                stages[-1] = last[:op_start]
+        text = line[start:end].strip()
+        if text:
+            statements.append(Statement(text, [stage.strip() for stage in stages], target, append))
+
+    for m in COMMAND_TOKEN_RE.finditer(line):
+        c = m.group()
+        if c[0] in '\'"':
+            continue
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth = max(depth - 1, 0)
+        elif depth:
+            continue
+        elif c == ';' and split:
+            finish(m.start())
+            start, cuts, redirect = m.end(), [], None
+        elif c == '|':
+            cuts.append(m.start())
+            redirect = None
+        elif c == '>':
+            redirect = m.start()
+    finish(len(line))
+    return statements
+
+def split_statements(line):
+    """The `;`-separated statements of a line, as text."""
+    return [statement.text for statement in lex_command_line(line)]
+
+# Literals that can be factored out of a SELECT so statements differing only
+# in values share one cached plan. Numbers after LIMIT/OFFSET and LIKE
+# patterns shape the plan itself and are kept verbatim.
+SQL_LITERAL_RE = re.compile(
+    r"(?P<keep>(?:LIKE|LIMIT|OFFSET)\s+(?:'[^']*'|\d+))"
+    r"|'(?P<single>[^']*)'"
+    r'|"(?P<double>[^"]*)"'
+    r"|(?<![\w.$])(?P<number>-?\d+(?:\.\d+)?)(?![\w.])",
+    re.IGNORECASE
+)
+# Runs of whitespace, skipping over quoted literals so their contents are kept
+WHITESPACE_RE = re.compile(r"""(?P<quoted>'[^']*'|"[^"]*")|\s+""")
+PARAM_MARKER = "__pymdbsh_param{}__"
+
+def normalize_sql(sql):
+    """Collapse whitespace outside quoted literals into single spaces."""
+    return WHITESPACE_RE.sub(lambda m: m.group('quoted') or ' ', sql.strip())
+
+def parameterize_sql(sql):
+    """Split a SELECT into a literal-free template and its literal values.
+
+    Returns (template, params) where each literal is replaced by a marker;
+    quoted literals keep their quotes so the template parses the same way.
+    """
+    params = []
+
+    def repl(m):
+        if m.group('keep'):
+            return m.group('keep')
+        marker = PARAM_MARKER.format(len(params))
+        if m.group('number') is not None:
+            text = m.group('number')
             try:
-                right_doc = cli.db[right_coll].find_one() if hasattr(cli, 'db') else None
-            except Exception:
-                pass
-            if left_doc:
-                left_fields = [k for k in left_doc.keys() if k != '_id']
-            if right_doc:
-                right_fields = [k for k in right_doc.keys() if k != '_id']
-
-            for field in fields:
-                if field == f"{left_alias}.*":
-                    for lf in left_fields:
-                        project[lf] = f"${lf}"
-                elif field == f"{right_alias}.*":
-                    for rf in right_fields:
-                        project[f"{right_alias}.{rf}"] = f"${right_alias}.{rf}"
-                elif '.' in field:
-                    alias, fname = field.split('.', 1)
-                    if alias == left_alias:
-                        project[fname] = f"${fname}"
-                    elif alias == right_alias:
-                        project[f"{right_alias}.{fname}"] = f"${right_alias}.{fname}"
-                else:
-                    project[field] = f"${field}"
-
-        # Initialize pipeline before appending to it!
-        pipeline = [lookup_stage, unwind_stage]
-
-        # WHERE clause (only simple ANDs supported)
-        if where_clause:
-            filter_doc = {}
-            
-            conditions = [c.strip() for c in re.split(r"\s+AND\s+", where_clause, flags=re.IGNORECASE)]
-            for cond in conditions:
-                print (f"condition is {cond}")
-                m = re.match(r"(\w+)\.(\w+)\s*=\s*(['\"])(.*?)\3", cond)
-                if m:
-                    alias, key, _, value = m.groups()
-                    # If alias is left_alias, use just the key (no prefix)
-                    if alias == left_alias:
-                        filter_doc[key] = value
-                    else:
-                        filter_doc[f"{alias}.{key}"] = value
-                    continue
-                m = re.match(r"(\w+)\.(\w+)\s*=\s*'([^']*)'", cond)
-                if m:
-                    alias, key, value = m.groups()
-                    print (f"alias={alias}, key={key}, value={value}")
-                    # If alias is left_alias, use just the key (no prefix)
-                    if alias == left_alias:
-                        filter_doc[key] = value
-                    else:
-                        filter_doc[f"{alias}.{key}"] = value
-                    continue
-                m = re.match(r"(\w+)\.(\w+)\s*=\s*(\d+)", cond)
-                if m:
-                    alias, key, value = m.groups()
-                    print (f"alias={alias}, key={key}, value={value}")
-                    if alias == left_alias:
-                        filter_doc[key] = int(value)
-                    else:
-                        filter_doc[f"{alias}.{key}"] = int(value)
-                    continue
-                # Add more condition parsing as needed
-                print(f"filter_doc so far: {filter_doc}")
-            if filter_doc:
-                pipeline.append({"$match": filter_doc})
-
-        if project:
-            pipeline.append({"$project": project})
-
-        # ORDER BY
-        if order_by_field:
-            direction = -1 if order_by_dir and order_by_dir.upper() == "DESC" else 1
-            pipeline.append({"$sort": {order_by_field: direction}})
-        # LIMIT
-        if limit_val:
-            pipeline.append({"$limit": int(limit_val)})
-
-        return left_coll, 'aggregate', [pipeline], None, None
-
-    # Fallback to original SELECT (no join)
-    # Regex to capture SELECT ... FROM ... [WHERE ...] [GROUP BY ...] [ORDER BY ...] [LIMIT ...]
-    match = re.match(
-        r"SELECT\s+(.+)\s+FROM\s+(\w+)"
-        r"(?:\s+WHERE\s+(.+?))?"
-        r"(?:\s+GROUP\s+BY\s+([\w\.]+))?"
-        r"(?:\s+HAVING\s+(.+?))?"
-        r"(?:\s+ORDER\s+BY\s+([\w\.]+)(?:\s+(ASC|DESC))?)?"
-        r"(?:\s+LIMIT\s+(\d+))?$",
-        sql, re.IGNORECASE
-    )
-    if not match:
-        print("Unsupported SQL syntax.")
+                params.append(int(text))
+            except ValueError:
+                params.append(float(text))
+            return marker
+        quote = "'" if m.group('single') is not None else '"'
+        params.append(m.group('single') if m.group('single') is not None else m.group('double'))
+        return f"{quote}{marker}{quote}"
+
+    template = SQL_LITERAL_RE.sub(repl, normalize_sql(sql))
+    return template, params
+
+def bind_plan(plan, params):
+    """Substitute literal values for the markers in a template plan.
+
+    Returns None when the markers did not each survive translation as a
+    whole value exactly once, meaning the template cannot be reused.
+    """
+    markers = {PARAM_MARKER.format(i): value for i, value in enumerate(params)}
+    seen = set()
+
+    def bind(node):
+        if isinstance(node, dict):
+            out = {}
+            for k, v in node.items():
+                if isinstance(k, str) and '__pymdbsh_param' in k:
+                    raise ValueError(k)
+                out[k] = bind(v)
+            return out
+        if isinstance(node, tuple) and hasattr(node, '_fields'):
+            return type(node)(*(bind(v) for v in node))
+        if isinstance(node, (list, tuple)):
+            return type(node)(bind(v) for v in node)
+        if isinstance(node, str) and '__pymdbsh_param' in node:
+            if node not in markers or node in seen:
+                raise ValueError(node)
+            seen.add(node)
+            return markers[node]
+        return node
+
+    try:
+        bound = bind(plan)
+    except ValueError:
+        return None
+    return bound if len(seen) == len(markers) else None
+
+class PlanCache:
+    """Size-limited LRU cache of SQL translations.
+
+    Entries are keyed by the parameterized statement text, so
+    `WHERE age > 21` and `WHERE age > 30` share one plan. Statements whose
+    literals can't be factored out are cached under their exact text.
+    Plans that depend on sampled field names (JOINs selecting `alias.*`)
+    are never cached; the schema cache keeps those cheap instead.
+    """
+    EXACT = object()  # template entry meaning "look up the exact text instead"
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        return None
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def translate(self, sql, schema=None, log=print):
+        if self.maxsize <= 0:
+            return translate_sql(sql, log=log, schema=schema)
+        # Plans built from sampled field names depend on live data, not just
+        # the statement text, so they bypass the cache
+        used_schema = []
+
+        def recording_schema(collection):
+            used_schema.append(collection)
+            return schema(collection) if schema is not None else []
+
+        template, params = parameterize_sql(sql)
+        entry = self._get(template)
+        if entry is not None and entry is not self.EXACT:
+            bound = bind_plan(entry, params)
+            if bound is not None:
+                self.hits += 1
+                return bound
+        exact_key = normalize_sql(sql)
+        if entry is self.EXACT:
+            plan = self._get(('exact', exact_key))
+            if plan is not None:
+                self.hits += 1
+                return copy.deepcopy(plan)
+        self.misses += 1
+        if entry is None and params:
+            # Templates that produce warnings are not shared, so the
+            # warnings are shown for every statement that triggers them
+            warnings = []
+            template_plan = translate_sql(template, log=warnings.append, schema=recording_schema)
+            if (template_plan is not None and not warnings and not used_schema
+                    and bind_plan(template_plan, params) is not None):
+                self._put(template, template_plan)
+                return bind_plan(template_plan, params)
+            if not used_schema:
+                self._put(template, self.EXACT)
+        warnings = []
+        plan = translate_sql(sql, log=warnings.append, schema=recording_schema)
+        for warning in warnings:
+            log(warning)
+        if plan is not None and not warnings and not used_schema:
+            self._put(('exact', exact_key) if params else template, plan)
+            return copy.deepcopy(plan)
+        return plan
+
+def sql_to_mongo(sql, cache=None, schema=None, log=print):
+    """Translate a SELECT statement, reusing a cached plan when one is given."""
+    if cache is None:
+        return translate_sql(sql, log=log, schema=schema)
+    return cache.translate(sql, schema, log)
+
+class SQLSyntaxError(ValueError):
+    """Raised for SELECT statements outside the supported subset."""
+
+# AST for the supported SELECT subset
+Column = namedtuple('Column', 'name alias')
+Star = namedtuple('Star', 'table')
+Aggregate = namedtuple('Aggregate', 'func arg distinct alias')
+FieldRef = namedtuple('FieldRef', 'name')
+Compare = namedtuple('Compare', 'left op right')
+InList = namedtuple('InList', 'left values negated')
+Between = namedtuple('Between', 'left low high negated')
+Like = namedtuple('Like', 'left pattern negated')
+IsNull = namedtuple('IsNull', 'left negated')
+BoolOp = namedtuple('BoolOp', 'op items')
+Not = namedtuple('Not', 'item')
+Join = namedtuple('Join', 'collection alias left_key right_key outer')
+OrderItem = namedtuple('OrderItem', 'key direction')
+Select = namedtuple('Select', 'fields collection alias join where group_by having order_by limit offset')
+
+# Translated query: find(*args).sort(sort).skip(skip).limit(limit), aggregate(*args),
+# or a count_documents/estimated_document_count(*args) returned as {output: n}.
+# empty is the row to return when the query yields none (aggregates without GROUP BY)
+QueryPlan = namedtuple('QueryPlan', 'collection method args sort limit skip output empty',
+                       defaults=(None, None, None, None, None))
+
+SQL_KEYWORDS = {
+    'SELECT', 'FROM', 'WHERE', 'JOIN', 'INNER', 'LEFT', 'OUTER', 'ON', 'AND', 'OR', 'NOT',
+    'IN', 'BETWEEN', 'LIKE', 'IS', 'NULL', 'TRUE', 'FALSE', 'GROUP', 'BY', 'HAVING',
+    'ORDER', 'ASC', 'DESC', 'LIMIT', 'OFFSET', 'AS', 'DISTINCT',
+}
+AGGREGATE_FUNCTIONS = ('COUNT', 'SUM', 'AVG', 'MIN', 'MAX')
+COMPARISON_OPERATORS = {
+    '=': '$eq', '==': '$eq', '!=': '$ne', '<>': '$ne',
+    '>': '$gt', '>=': '$gte', '<': '$lt', '<=': '$lte',
+}
+SQL_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+      | (?P<number>\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)
+      | (?P<name>[A-Za-z_$][\w$]*(?:\.(?:[A-Za-z_$][\w$]*|\*))*)
+      | (?P<op><=|>=|<>|!=|==|[=<>(),*\-])
+    )""", re.VERBOSE)
+PARAM_MARKER_RE = re.compile(r"__pymdbsh_param\d+__")
+
+def tokenize_sql(sql):
+    """Split a statement into (kind, value) tokens in a single left-to-right scan.
+
+    kind is one of string, number, name, keyword, param, op or eof.
+    """
+    tokens = []
+    pos = 0
+    end = len(sql.rstrip())
+    while pos < end:
+        m = SQL_TOKEN_RE.match(sql, pos)
+        if not m:
+            raise SQLSyntaxError(f"unexpected character {sql[pos:].lstrip()[:1]!r} at position {pos}")
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'string':
+            value = text[1:-1].replace(text[0] * 2, text[0])
+        elif kind == 'number':
+            value = float(text) if any(c in text for c in '.eE') else int(text)
+        elif kind == 'name' and text.upper() in SQL_KEYWORDS:
+            kind, value = 'keyword', text.upper()
+        elif kind == 'name' and PARAM_MARKER_RE.fullmatch(text):
+            kind, value = 'param', text
+        else:
+            value = text
+        tokens.append((kind, value))
+        pos = m.end()
+    tokens.append(('eof', None))
+    return tokens
+
+class SQLParser:
+    """Recursive-descent parser for the supported SELECT subset.
+
+    Each token is looked at a constant number of times, so parsing is
+    linear in the length of the statement.
+    """
+    def __init__(self, sql):
+        self.tokens = tokenize_sql(sql)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        if token[0] != 'eof':
+            self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            return self.advance()
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            found = self.peek()[1] if self.peek()[0] != 'eof' else 'end of statement'
+            raise SQLSyntaxError(f"expected {value or kind}, found {found!r}")
+        return token
+
+    def parse(self):
+        self.expect('keyword', 'SELECT')
+        fields = [self.parse_select_item()]
+        while self.accept('op', ','):
+            fields.append(self.parse_select_item())
+        self.expect('keyword', 'FROM')
+        collection = self.expect('name')[1]
+        alias = self.parse_alias() or collection
+        join = self.parse_join()
+        where = self.parse_or() if self.accept('keyword', 'WHERE') else None
+        group_by = []
+        if self.accept('keyword', 'GROUP'):
+            self.expect('keyword', 'BY')
+            group_by.append(self.expect('name')[1])
+            while self.accept('op', ','):
+                group_by.append(self.expect('name')[1])
+        having = self.parse_or() if self.accept('keyword', 'HAVING') else None
+        order_by = []
+        if self.accept('keyword', 'ORDER'):
+            self.expect('keyword', 'BY')
+            order_by.append(self.parse_order_item())
+            while self.accept('op', ','):
+                order_by.append(self.parse_order_item())
+        limit = offset = None
+        while True:
+            if limit is None and self.accept('keyword', 'LIMIT'):
+                limit = self.expect('number')[1]
+            elif offset is None and self.accept('keyword', 'OFFSET'):
+                offset = self.expect('number')[1]
+            else:
+                break
+        self.expect('eof')
+        return Select(fields, collection, alias, join, where, group_by, having, order_by, limit, offset)
+
+    def parse_alias(self):
+        if self.accept('keyword', 'AS'):
+            return self.expect('name')[1]
+        token = self.accept('name')
+        return token[1] if token else None
+
+    def parse_select_item(self):
+        if self.accept('op', '*'):
+            return Star(None)
+        name = self.expect('name')[1]
+        if name.endswith('.*'):
+            return Star(name[:-2])
+        if self.peek() == ('op', '('):
+            func, arg, distinct = self.parse_aggregate_call(name)
+            return Aggregate(func, arg, distinct, self.parse_alias())
+        return Column(name, self.parse_alias())
+
+    def parse_aggregate_call(self, name):
+        func = name.upper()
+        if func not in AGGREGATE_FUNCTIONS:
+            raise SQLSyntaxError(f"unsupported function {name}()")
+        self.expect('op', '(')
+        distinct = self.accept('keyword', 'DISTINCT') is not None
+        if func == 'COUNT' and not distinct and self.accept('op', '*'):
+            arg = None
+        else:
+            arg = self.expect('name')[1]
+        self.expect('op', ')')
+        return func, arg, distinct
+
+    def parse_join(self):
+        outer = False
+        if self.accept('keyword', 'LEFT'):
+            self.accept('keyword', 'OUTER')
+            outer = True
+        elif self.accept('keyword', 'INNER'):
+            pass
+        elif self.peek() != ('keyword', 'JOIN'):
+            return None
+        self.expect('keyword', 'JOIN')
+        collection = self.expect('name')[1]
+        alias = self.parse_alias() or collection
+        self.expect('keyword', 'ON')
+        left_key = self.expect('name')[1]
+        self.expect('op', '=')
+        right_key = self.expect('name')[1]
+        return Join(collection, alias, left_key, right_key, outer)
+
+    def parse_order_item(self):
+        name = self.expect('name')[1]
+        if self.peek() == ('op', '('):
+            func, arg, distinct = self.parse_aggregate_call(name)
+            key = Aggregate(func, arg, distinct, None)
+        else:
+            key = FieldRef(name)
+        direction = -1 if self.accept('keyword', 'DESC') else 1
+        if direction == 1:
+            self.accept('keyword', 'ASC')
+        return OrderItem(key, direction)
+
+    def parse_or(self):
+        items = [self.parse_and()]
+        while self.accept('keyword', 'OR'):
+            items.append(self.parse_and())
+        return items[0] if len(items) == 1 else BoolOp('or', items)
+
+    def parse_and(self):
+        items = [self.parse_not()]
+        while self.accept('keyword', 'AND'):
+            items.append(self.parse_not())
+        return items[0] if len(items) == 1 else BoolOp('and', items)
+
+    def parse_not(self):
+        if self.accept('keyword', 'NOT'):
+            return Not(self.parse_not())
+        if self.accept('op', '('):
+            expr = self.parse_or()
+            self.expect('op', ')')
+            return expr
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        name = self.expect('name')[1]
+        if self.peek() == ('op', '('):
+            func, arg, distinct = self.parse_aggregate_call(name)
+            left = Aggregate(func, arg, distinct, None)
+        else:
+            left = FieldRef(name)
+        kind, value = self.peek()
+        if kind == 'op' and value in COMPARISON_OPERATORS:
+            self.advance()
+            return Compare(left, value, self.parse_value(allow_field=True))
+        if self.accept('keyword', 'IS'):
+            negated = self.accept('keyword', 'NOT') is not None
+            self.expect('keyword', 'NULL')
+            return IsNull(left, negated)
+        negated = self.accept('keyword', 'NOT') is not None
+        if self.accept('keyword', 'IN'):
+            self.expect('op', '(')
+            values = [self.parse_value()]
+            while self.accept('op', ','):
+                values.append(self.parse_value())
+            self.expect('op', ')')
+            return InList(left, values, negated)
+        if self.accept('keyword', 'BETWEEN'):
+            low = self.parse_value()
+            self.expect('keyword', 'AND')
+            return Between(left, low, self.parse_value(), negated)
+        if self.accept('keyword', 'LIKE'):
+            kind, pattern = self.advance()
+            if kind not in ('string', 'param'):
+                raise SQLSyntaxError("LIKE expects a quoted pattern")
+            return Like(left, pattern, negated)
+        raise SQLSyntaxError(f"unsupported condition on {name}")
+
+    def parse_value(self, allow_field=False):
+        kind, value = self.advance()
+        if kind in ('string', 'number', 'param'):
+            return value
+        if kind == 'keyword' and value in ('TRUE', 'FALSE', 'NULL'):
+            return {'TRUE': True, 'FALSE': False, 'NULL': None}[value]
+        if kind == 'op' and value == '-':
+            return -self.expect('number')[1]
+        if kind == 'name' and allow_field:
+            return FieldRef(value)
+        raise SQLSyntaxError(f"expected a value, found {value!r}" if kind != 'eof' else "expected a value at end of statement")
+
+def like_to_regex(pattern):
+    """Translate a SQL LIKE pattern to an anchored regular expression."""
+    parts = []
+    for c in pattern:
+        parts.append('.*' if c == '%' else '.' if c == '_' else re.escape(c))
+    regex = '^' + ''.join(parts) + '$'
+    # A trailing wildcard needs no end anchor; keeping only the prefix
+    # anchor lets the server use an index for 'abc%' patterns
+    return regex[:-3] if regex.endswith('.*$') else regex
+
+def compile_condition(node, resolve):
+    """Compile a WHERE/HAVING expression to a MongoDB filter document.
+
+    resolve maps a FieldRef or Aggregate to the document path it reads.
+    """
+    if isinstance(node, BoolOp):
+        parts = [compile_condition(item, resolve) for item in node.items]
+        if node.op == 'or':
+            return {"$or": parts}
+        return merge_conjunction(parts)
+    if isinstance(node, Not):
+        return {"$nor": [compile_condition(node.item, resolve)]}
+    field = resolve(node.left)
+    if isinstance(node, Compare):
+        op = COMPARISON_OPERATORS[node.op]
+        if isinstance(node.right, FieldRef):
+            return {"$expr": {op: [f"${field}", f"${resolve(node.right)}"]}}
+        return {field: node.right} if op == '$eq' else {field: {op: node.right}}
+    if isinstance(node, InList):
+        return {field: {"$nin" if node.negated else "$in": list(node.values)}}
+    if isinstance(node, Between):
+        if node.negated:
+            return {"$or": [{field: {"$lt": node.low}}, {field: {"$gt": node.high}}]}
+        return {field: {"$gte": node.low, "$lte": node.high}}
+    if isinstance(node, Like):
+        regex = {"$regex": like_to_regex(node.pattern)}
+        return {field: {"$not": regex}} if node.negated else {field: regex}
+    if isinstance(node, IsNull):
+        return {field: {"$ne": None}} if node.negated else {field: None}
+    raise SQLSyntaxError(f"unsupported condition {node!r}")
+
+def merge_conjunction(parts):
+    """AND filters together, folding `age >= 18 AND age < 65` into one range."""
+    merged = {}
+    rest = []
+    for part in parts:
+        if "$and" in part and len(part) == 1:
+            part_items = [(k, v) for sub in part["$and"] for k, v in sub.items()]
+        else:
+            part_items = part.items()
+        for key, value in part_items:
+            if key not in merged:
+                merged[key] = value
+            # Only operator dicts under a field path fold; $expr etc. must keep one operator each
+            elif (not key.startswith('$') and isinstance(merged[key], dict) and isinstance(value, dict)
+                    and all(k.startswith('$') for k in list(merged[key]) + list(value))
+                    and not set(merged[key]) & set(value)):
+                merged[key] = {**merged[key], **value}
+            else:
+                rest.append({key: value})
+    if rest:
+        return {"$and": [{k: v} for k, v in merged.items()] + rest}
+    return merged
+
+def aggregate_name(node):
+    """Output field name of an aggregate: its alias, or e.g. count, sum_price."""
+    if node.alias:
+        return node.alias
+    if node.arg is None:
+        return 'count'
+    prefix = f"{node.func.lower()}_distinct" if node.distinct else node.func.lower()
+    return f"{prefix}_{node.arg.replace('.', '_')}"
+
+def aggregate_accumulator(node, path):
+    """$group accumulator for an aggregate function over a document path.
+
+    COUNT, SUM and AVG with DISTINCT collect the group's set of values;
+    distinct_result turns the set into the result after the $group.
+    """
+    if node.func == 'COUNT' and node.arg is None:
+        return {"$sum": 1}
+    if node.distinct and node.func in ('COUNT', 'SUM', 'AVG'):
+        return {"$addToSet": f"${path}"}
+    if node.func == 'COUNT':
+        return {"$sum": {"$cond": [{"$eq": [{"$ifNull": [f"${path}", None]}, None]}, 0, 1]}}
+    return {f"${node.func.lower()}": f"${path}"}
+
+def distinct_result(node, name):
+    """Expression reducing the value set of a DISTINCT aggregate, or None for other aggregates."""
+    if not node.distinct or node.func not in ('COUNT', 'SUM', 'AVG'):
+        return None
+    if node.func == 'COUNT':
+        return {"$size": {"$filter": {"input": f"${name}", "cond": {"$ne": ["$$this", None]}}}}
+    return {f"${node.func.lower()}": f"${name}"}
+
+def single_count(stmt):
+    """The COUNT of a `SELECT COUNT(...) FROM ... [WHERE ...]` that yields one number, else None."""
+    if (len(stmt.fields) != 1 or stmt.group_by or stmt.having is not None
+            or stmt.order_by or stmt.offset):
         return None
+    field = stmt.fields[0]
+    return field if isinstance(field, Aggregate) and field.func == 'COUNT' else None
 
-    fields = match.group(1).replace(' ', '').split(',')
-    collection = match.group(2)
-    where_clause = match.group(3)
-    group_by_field = match.group(4)
-    having_clause = match.group(5)
-    order_by_field = match.group(6)
-    order_by_dir = match.group(7)
-    limit_val = match.group(8)
+def empty_row(stmt):
+    """The row aggregates without GROUP BY give over no documents: counts are 0, the rest null.
 
+    $group and $count output nothing for empty input, so the client adds
+    this row instead. None when HAVING or OFFSET could drop the row.
+    """
+    if stmt.group_by or stmt.having is not None or stmt.offset:
+        return None
+    return {aggregate_name(f): 0 if f.func == 'COUNT' else None
+            for f in stmt.fields if isinstance(f, Aggregate)}
+
+def compile_select(stmt, schema=None):
+    """Turn a parsed Select into a QueryPlan.
+
+    Plain selections become find() with the filter, projection, sort,
+    skip and limit pushed to the server. JOINs, GROUP BY, aggregates and
+    column aliases become an aggregation pipeline that starts with $match.
+    """
+    join = stmt.join
+    left_prefix = f"{stmt.alias}."
+    right_prefix = f"{join.alias}." if join else None
+
+    def field_path(name):
+        if join and name.startswith(right_prefix):
+            return f"{join.alias}.{name[len(right_prefix):]}"
+        if name.startswith(left_prefix):
+            return name[len(left_prefix):]
+        return name
+
+    aggregates = [f for f in stmt.fields if isinstance(f, Aggregate)]
+    aliased = any(isinstance(f, Column) and f.alias for f in stmt.fields)
+    if join is None and not stmt.group_by and not aggregates and not aliased:
+        return compile_find(stmt, field_path)
+    count = single_count(stmt)
+    if join is None and count is not None and not count.distinct:
+        return compile_count(stmt, count, field_path)
+
+    pipeline = []
+    if join:
+        left_key, right_key = join.left_key, join.right_key
+        if left_key.startswith(right_prefix):
+            left_key, right_key = right_key, left_key
+        pipeline.append({
+            "$lookup": {
+                "from": join.collection,
+                "localField": field_path(left_key),
+                "foreignField": right_key[len(right_prefix):] if right_key.startswith(right_prefix) else right_key,
+                "as": join.alias
+            }
+        })
+        # Inner joins drop unmatched documents; LEFT JOIN keeps them
+        pipeline.append({"$unwind": {"path": f"${join.alias}", "preserveNullAndEmptyArrays": join.outer}})
+
+    def resolve_field(node):
+        if isinstance(node, Aggregate):
+            raise SQLSyntaxError("aggregate functions are only allowed in HAVING and ORDER BY")
+        return field_path(node.name)
+
+    if stmt.where is not None:
+        pipeline.append({"$match": compile_condition(stmt.where, resolve_field)})
+
+    if stmt.group_by or aggregates:
+        pipeline += compile_grouping(stmt, field_path)
+        return QueryPlan(stmt.collection, 'aggregate', [pipeline], empty=empty_row(stmt))
+
+    aliases = {f.alias: field_path(f.name) for f in stmt.fields if isinstance(f, Column) and f.alias}
+    if stmt.order_by:
+        sort = {}
+        for item in stmt.order_by:
+            name = resolve_field(item.key)
+            sort[aliases.get(item.key.name, name)] = item.direction
+        pipeline.append({"$sort": sort})
+    if stmt.offset:
+        pipeline.append({"$skip": stmt.offset})
+    if stmt.limit:
+        pipeline.append({"$limit": stmt.limit})
+
+    project = compile_projection(stmt, field_path, schema)
+    if project:
+        pipeline.append({"$project": project})
+    return QueryPlan(stmt.collection, 'aggregate', [pipeline])
+
+def compile_find(stmt, field_path):
     filter_doc = {}
-    projection = None
-    sort = None
-    limit = None
+    if stmt.where is not None:
+        filter_doc = compile_condition(stmt.where, lambda node: field_path(node.name))
+    args = [filter_doc]
+    if not any(isinstance(f, Star) for f in stmt.fields):
+        args.append({field_path(f.name): 1 for f in stmt.fields})
+    for item in stmt.order_by:
+        if isinstance(item.key, Aggregate):
+            raise SQLSyntaxError("ORDER BY an aggregate requires GROUP BY")
+    sort = [(field_path(item.key.name), item.direction) for item in stmt.order_by] or None
+    return QueryPlan(stmt.collection, 'find', args, sort, stmt.limit, stmt.offset)
 
-    # Handle SELECT * (no projection)
-    if len(fields) == 1 and fields[0] == '*':
-        projection = None
+def compile_count(stmt, node, field_path):
+    """Count on the server instead of fetching documents.
+
+    COUNT(*) without WHERE reads the collection's metadata count; anything
+    else becomes count_documents, with COUNT(field) skipping null and
+    missing values.
+    """
+    def resolve(node):
+        if isinstance(node, Aggregate):
+            raise SQLSyntaxError("aggregate functions are only allowed in HAVING and ORDER BY")
+        return field_path(node.name)
+
+    conditions = []
+    if stmt.where is not None:
+        conditions.append(compile_condition(stmt.where, resolve))
+    if node.arg is not None:
+        conditions.append({field_path(node.arg): {"$ne": None}})
+    name = aggregate_name(node)
+    if not conditions:
+        return QueryPlan(stmt.collection, 'estimated_document_count', [], output=name)
+    return QueryPlan(stmt.collection, 'count_documents', [merge_conjunction(conditions)], output=name)
+
+def compile_projection(stmt, field_path, schema):
+    """Build an expression $project for a non-grouped pipeline, or None for SELECT *."""
+    join = stmt.join
+    project = {}
+    for field in stmt.fields:
+        if isinstance(field, Star):
+            if field.table is None or (join is None and field.table == stmt.alias):
+                return None
+            if field.table == stmt.alias:
+                names = [k for k in (schema(stmt.collection) if schema else []) if k != '_id']
+                for name in names:
+                    project[name] = f"${name}"
+            elif join and field.table == join.alias:
+                names = [k for k in (schema(join.collection) if schema else []) if k != '_id']
+                for name in names:
+                    project[f"{join.alias}.{name}"] = f"${join.alias}.{name}"
+            else:
+                raise SQLSyntaxError(f"unknown table alias {field.table}")
+        else:
+            path = field_path(field.name)
+            project[field.alias or path] = f"${path}"
+    return project
+
+def compile_grouping(stmt, field_path):
+    """$group, HAVING $match, $sort, $skip, $limit and $project stages for GROUP BY/aggregates.
+
+    A lone COUNT without GROUP BY (after a JOIN, or COUNT(DISTINCT x))
+    ends in a $count stage instead, so no group state is accumulated.
+    """
+    count = single_count(stmt)
+    if count is not None:
+        stages = []
+        if count.distinct:
+            path = field_path(count.arg)
+            stages += [{"$group": {"_id": f"${path}"}}, {"$match": {"_id": {"$ne": None}}}]
+        elif count.arg is not None:
+            stages.append({"$match": {field_path(count.arg): {"$ne": None}}})
+        return stages + [{"$count": aggregate_name(count)}]
+
+    group_paths = [field_path(name) for name in stmt.group_by]
+    if not group_paths:
+        group_id = None
+        id_paths = {}
+    elif len(group_paths) == 1:
+        group_id = f"${group_paths[0]}"
+        id_paths = {group_paths[0]: "_id"}
     else:
-        projection = {field: 1 for field in fields if field != 'COUNT(*)'}
-
-    # WHERE clause (add LIKE support)
-    if where_clause:
-        conditions = [c.strip() for c in re.split(r"\s+AND\s+", where_clause, flags=re.IGNORECASE)]
-        for cond in conditions:
-            # LIKE
-            like_match = re.match(r"([\w\.]+)\s+LIKE\s+'([^']+)'", cond, re.IGNORECASE)
-            if like_match:
-                key = like_match.group(1)
-                pattern = like_match.group(2)
-                # Convert SQL LIKE pattern to regex
-                regex = '^' + pattern.replace('%', '.*').replace('_', '.') + '$'
-                filter_doc[key] = {"$regex": regex}
-                continue
-            # IS NULL
-            is_null_match = re.match(r"([\w\.]+)\s+IS\s+NULL", cond, re.IGNORECASE)
-            if is_null_match:
-                key = is_null_match.group(1)
-                filter_doc[key] = None
-                continue
-            # IS NOT NULL
-            is_not_null_match = re.match(r"([\w\.]+)\s+IS\s+NOT\s+NULL", cond, re.IGNORECASE)
-            if is_not_null_match:
-                key = is_not_null_match.group(1)
-                filter_doc[key] = {"$ne": None}
-                continue
-            # Try to match a.userid = 'value' or a.userid = "value"
-            m = re.match(r"(\w+)\.(\w+)\s*=\s*(['\"])(.*?)\3", cond)
-            if m:
-                alias, key, _, value = m.groups()
-                # If alias is left_alias, use just the key (no prefix)
-                if alias == left_alias:
-                    filter_doc[key] = value
+        group_id = {p.replace('.', '_'): f"${p}" for p in group_paths}
+        id_paths = {p: f"_id.{p.replace('.', '_')}" for p in group_paths}
+
+    group = {"_id": group_id}
+    accumulators = {}  # (func, arg, distinct) -> output name
+    reduced = {}  # DISTINCT aggregate name -> expression over its value set
+
+    def accumulate(node):
+        key = (node.func, node.arg, node.distinct)
+        if key not in accumulators:
+            name = aggregate_name(node)
+            group[name] = aggregate_accumulator(node, field_path(node.arg) if node.arg else None)
+            accumulators[key] = name
+            if distinct_result(node, name) is not None:
+                reduced[name] = distinct_result(node, name)
+        return accumulators[key]
+
+    project = {"_id": 0}
+    aliases = {}
+    for field in stmt.fields:
+        if isinstance(field, Star):
+            raise SQLSyntaxError("SELECT * cannot be combined with GROUP BY or aggregates")
+        if isinstance(field, Aggregate):
+            name = accumulate(field)
+            project[field.alias or name] = f"${name}"
+            aliases[field.alias or name] = name
+            continue
+        path = field_path(field.name)
+        out = field.alias or path
+        if path in id_paths:
+            project[out] = f"${id_paths[path]}"
+            aliases[out] = id_paths[path]
+        else:
+            # Non-grouped columns take the value from the first document of each group
+            name = path.replace('.', '_')
+            group[name] = {"$first": f"${path}"}
+            project[out] = f"${name}"
+            aliases[out] = name
+
+    def resolve_grouped(node):
+        if isinstance(node, Aggregate):
+            return accumulate(node)
+        path = field_path(node.name)
+        if path in id_paths:
+            return id_paths[path]
+        if node.name in aliases:
+            return aliases[node.name]
+        raise SQLSyntaxError(f"{node.name} must appear in GROUP BY or be aggregated")
+
+    having = compile_condition(stmt.having, resolve_grouped) if stmt.having is not None else None
+    sort = {resolve_grouped(item.key): item.direction for item in stmt.order_by}
+
+    stages = [{"$group": group}]
+    if reduced:
+        stages.append({"$addFields": reduced})
+    if having:
+        stages.append({"$match": having})
+    if sort:
+        stages.append({"$sort": sort})
+    if stmt.offset:
+        stages.append({"$skip": stmt.offset})
+    if stmt.limit:
+        stages.append({"$limit": stmt.limit})
+    stages.append({"$project": project})
+    return stages
+
+def pipeline_field_refs(stages):
+    """Collect the document paths read by a list of pipeline stages."""
+    refs = set()
+
+    def walk_expr(node):
+        if isinstance(node, str):
+            if node.startswith('$') and not node.startswith('$$'):
+                refs.add(node[1:])
+        elif isinstance(node, dict):
+            for value in node.values():
+                walk_expr(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk_expr(value)
+
+    for stage in stages:
+        name, body = next(iter(stage.items()))
+        if name == '$match':
+            refs.update(match_field_refs(body))
+        elif name == '$sort':
+            refs.update(body)
+        elif name in ('$project', '$group'):
+            for key, value in body.items():
+                if name == '$project' and value in (1, True) and key != '_id':
+                    refs.add(key)
                 else:
-                    filter_doc[f"{alias}.{key}"] = value
-                continue
-            eq_match = re.match(r"([\w\.]+)\s*=\s*'([^']*)'", cond)
-            if eq_match:
-                key = eq_match.group(1)
-                value = eq_match.group(2)
-                filter_doc[key] = value
-                continue
-            eq_match = re.match(r'([\w\.]+)\s*=\s*"([^"]*)"', cond)
-            if eq_match:
-                key = eq_match.group(1)
-                value = eq_match.group(2)
-                filter_doc[key] = value
-                continue
-            bool_match = re.match(r"([\w\.]+)\s*=\s*(true|false)", cond, re.IGNORECASE)
-            if bool_match:
-                key = bool_match.group(1)
-                value = bool_match.group(2).lower() == "true"
-                filter_doc[key] = value
-                continue
-            ne_match = re.match(r"([\w\.]+)\s*!=\s*'([^']*)'", cond)
-            if ne_match:
-                key = ne_match.group(1)
-                value = ne_match.group(2)
-                filter_doc[key] = {"$ne": value}
-                continue
-            ne_match = re.match(r'([\w\.]+)\s*!=\s*"([^"]*)"', cond)
-            if ne_match:
-                key = ne_match.group(1)
-                value = ne_match.group(2)
-                filter_doc[key] = {"$ne": value}
-                continue
-            ne_bool_match = re.match(r"([\w\.]+)\s*!=\s*(true|false)", cond, re.IGNORECASE)
-            if ne_bool_match:
-                key = ne_bool_match.group(1)
-                value = ne_bool_match.group(2).lower() == "true"
-                filter_doc[key] = {"$ne": value}
-                continue
-            gt_match = re.match(r"([\w\.]+)\s*>\s*([^\s]+)", cond)
-            if gt_match:
-                key = gt_match.group(1)
-                value = gt_match.group(2)
-                try:
-                    value = int(value)
-                except ValueError:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-                filter_doc[key] = {"$gt": value}
-                continue
-            lt_match = re.match(r"([\w\.]+)\s*<\s*([^\s]+)", cond)
-            if lt_match:
-                key = lt_match.group(1)
-                value = lt_match.group(2)
-                try:
-                    value = int(value)
-                except ValueError:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-                filter_doc[key] = {"$lt": value}
-                continue
-            gte_match = re.match(r"([\w\.]+)\s*>=\s*([^\s]+)", cond)
-            if gte_match:
-                key = gte_match.group(1)
-                value = gte_match.group(2)
-                try:
-                    value = int(value)
-                except ValueError:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-                filter_doc[key] = {"$gte": value}
-                continue
-            lte_match = re.match(r"([\w\.]+)\s*<=\s*([^\s]+)", cond)
-            if lte_match:
-                key = lte_match.group(1)
-                value = lte_match.group(2)
-                try:
-                    value = int(value)
-                except ValueError:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-                filter_doc[key] = {"$lte": value}
-                continue
-            print(f"Unsupported WHERE condition: {cond}")
-
-    # GROUP BY support with HAVING
-    if group_by_field:
-        pipeline = []
-        if where_clause and filter_doc:
-            pipeline.append({"$match": filter_doc})
-        group_stage = {
-            "$group": {
-                "_id": f"${group_by_field}",
-                "count": {"$sum": 1}
-            }
-        }
-        for field in fields:
-            if field not in ('COUNT(*)', group_by_field):
-                group_stage["$group"][field] = {"$first": f"${field}"}
-        pipeline.append(group_stage)
-        # HAVING support (only for COUNT(*) for now)
-        if having_clause:
-            having_match = re.match(r"COUNT\(\*\)\s*([<>=!]+)\s*(\d+)", having_clause.strip(), re.IGNORECASE)
-            if having_match:
-                op, value = having_match.group(1), int(having_match.group(2))
-                mongo_op = {
-                    '=': '$eq',
-                    '==': '$eq',
-                    '!=': '$ne',
-                    '<>': '$ne',
-                    '>': '$gt',
-                    '>=': '$gte',
-                    '<': '$lt',
-                    '<=': '$lte'
-                }.get(op)
-                if mongo_op:
-                    pipeline.append({"$match": {"count": {f"${mongo_op}": value}}})
-        # Project output fields
-        project_stage = {"$project": {group_by_field: "$_id", "count": 1}}
-        for field in fields:
-            if field not in ('COUNT(*)', group_by_field):
-                project_stage["$project"][field] = 1
-        pipeline.append(project_stage)
-        # ORDER BY
-        if order_by_field:
-            direction = -1 if order_by_dir and order_by_dir.upper() == "DESC" else 1
-            pipeline.append({"$sort": {order_by_field: direction}})
-        # LIMIT
-        if limit_val:
-            pipeline.append({"$limit": int(limit_val)})
-        return collection, 'aggregate', [pipeline], None, None
-
-    # ORDER BY (for non-grouped queries)
-    if order_by_field:
-        direction = -1 if order_by_dir and order_by_dir.upper() == "DESC" else 1
-        sort = [(order_by_field, direction)]
-
-    # LIMIT (for non-grouped queries)
-    if limit_val:
-        limit = int(limit_val)
-
-    # Return all options for execution
-    args = [filter_doc]
-    if projection is not None:
-        args.append(projection)
-    return collection, 'find', args, sort, limit
+                    walk_expr(value)
+    return refs
+
+def match_field_refs(filter_doc):
+    """Document paths read by a $match filter."""
+    refs = set()
+    for key, value in filter_doc.items():
+        if key in ('$and', '$or', '$nor'):
+            for sub in value:
+                refs.update(match_field_refs(sub))
+        elif key == '$expr':
+            refs.update(pipeline_field_refs([{"$project": {"expr": value}}]))
+        elif not key.startswith('$'):
+            refs.add(key)
+    return refs
+
+def filter_conjuncts(filter_doc):
+    """Split a filter into single-condition filters that are ANDed together."""
+    conjuncts = []
+    for key, value in filter_doc.items():
+        if key == '$and':
+            for sub in value:
+                conjuncts.extend(filter_conjuncts(sub))
+        else:
+            conjuncts.append({key: value})
+    return conjuncts
+
+def strip_field_prefix(node, prefix):
+    """Rewrite `b.x` paths (and `$b.x` expressions) to `x` for use inside a $lookup pipeline."""
+    if isinstance(node, dict):
+        return {(k[len(prefix):] if k.startswith(prefix) else k): strip_field_prefix(v, prefix)
+                for k, v in node.items()}
+    if isinstance(node, list):
+        return [strip_field_prefix(v, prefix) for v in node]
+    if isinstance(node, str) and node.startswith('$' + prefix):
+        return '$' + node[len(prefix) + 1:]
+    return node
+
+def order_top_k(pipeline):
+    """Keep $limit right behind $sort so the server runs a bounded top-k sort.
+
+    [$sort, $skip n, $limit m] becomes [$sort, $limit n+m, $skip n], and a
+    $project between $sort and $limit moves after the $limit.
+    """
+    stages = list(pipeline)
+    for i, stage in enumerate(stages):
+        if '$sort' not in stage:
+            continue
+        j = i + 1
+        moved = []
+        while j < len(stages) and '$project' in stages[j]:
+            moved.append(stages[j])
+            j += 1
+        skip = None
+        if j < len(stages) and '$skip' in stages[j]:
+            skip = stages[j]
+            j += 1
+        if j < len(stages) and '$limit' in stages[j]:
+            limit = stages[j]['$limit']
+            head = [{"$limit": limit + skip['$skip']}, skip] if skip else [stages[j]]
+            stages[i + 1:j + 1] = head + moved
+        break
+    return stages
+
+def optimize_pipeline(pipeline, lookup_pipeline=True):
+    """Rewrite a generated pipeline so less data flows through each stage.
+
+    For a leading $lookup + $unwind (a SQL JOIN):
+      * predicates on the left collection run in a $match before $lookup;
+      * for inner joins, predicates on the joined collection move into the
+        $lookup's own pipeline, together with a $project of the joined
+        fields that later stages use (concise correlated $lookup, MongoDB
+        5.0+; skipped when lookup_pipeline is false);
+      * left fields not used later are projected away before $lookup;
+      * a sort on left fields runs before $lookup, where an index can serve
+        it and a later $limit stops the join early.
+    Everywhere, $sort and $limit are kept adjacent for a top-k sort.
+    """
+    stages = copy.deepcopy(pipeline)
+    if (len(stages) < 2 or '$lookup' not in stages[0] or '$unwind' not in stages[1]
+            or 'localField' not in stages[0]['$lookup'] or 'pipeline' in stages[0]['$lookup']):
+        return order_top_k(stages)
+    lookup = stages[0]['$lookup']
+    alias = lookup['as']
+    prefix = alias + '.'
+    outer = stages[1]['$unwind'].get('preserveNullAndEmptyArrays', False)
+    rest = stages[2:]
+    before = []
+    inner = []
+
+    def is_joined(path):
+        return path == alias or path.startswith(prefix)
+
+    if rest and '$match' in rest[0]:
+        left, right, mixed = [], [], []
+        for cond in filter_conjuncts(rest[0]['$match']):
+            refs = match_field_refs(cond)
+            if refs and not any(is_joined(r) for r in refs):
+                left.append(cond)
+            elif lookup_pipeline and refs and all(is_joined(r) and r != alias for r in refs) and not outer:
+                right.append(strip_field_prefix(cond, prefix))
+            else:
+                mixed.append(cond)
+        rest = rest[1:]
+        if left:
+            before.append({"$match": merge_conjunction(left)})
+        if right:
+            inner.append({"$match": merge_conjunction(right)})
+        if mixed:
+            rest.insert(0, {"$match": merge_conjunction(mixed)})
+
+    grouped = any('$group' in stage for stage in rest)
+    for i, stage in enumerate(rest):
+        if '$sort' in stage and not grouped and not any(is_joined(k) for k in stage['$sort']):
+            # Lookup and unwind preserve order, so sorting first is equivalent
+            before.append(rest.pop(i))
+            break
+
+    # Project early only when later stages name the fields they need
+    shape_idx = next((i for i, s in enumerate(rest) if '$project' in s or '$group' in s or '$count' in s), None)
+    if shape_idx is not None:
+        refs = pipeline_field_refs(rest[:shape_idx + 1])
+        if lookup_pipeline and alias not in refs:
+            joined_fields = sorted({r[len(prefix):].split('.')[0] for r in refs if r.startswith(prefix)})
+            inner.append({"$project": {f: 1 for f in joined_fields} or {"_id": 1}})
+        left_fields = {r.split('.')[0] for r in refs if not is_joined(r)}
+        left_fields.add(lookup['localField'].split('.')[0])
+        before.append({"$project": {f: 1 for f in sorted(left_fields)}})
+
+    if inner:
+        lookup['pipeline'] = inner
+    return before + stages[:2] + order_top_k(rest)
+
+def translate_sql(sql, log=print, schema=None):
+    """Translate a SELECT statement into a QueryPlan.
+
+    Syntax errors are reported through log and return None. schema is an
+    optional callable returning the field names of a collection, used to
+    expand `alias.*` in JOINs.
+    """
+    try:
+        return compile_select(SQLParser(sql).parse(), schema)
+    except SQLSyntaxError as e:
+        log(f"Unsupported SQL: {e}")
+        return None
+
 if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="Python MongoDB CLI")
+    arg_parser.add_argument('--show-plan', action='store_true',
+                            help="print generated aggregation pipelines before and after optimization")
+    mode = arg_parser.add_mutually_exclusive_group()
+    mode.add_argument('-c', dest='command', metavar='CMD', help="run CMD (';'-separated commands) and exit")
+    mode.add_argument('-f', dest='script', metavar='FILE', help="run the commands in FILE ('-' for stdin) and exit")
+    arg_parser.add_argument('--parallel', action='store_true',
+                            help="with -c/-f/stdin, run consecutive read statements concurrently")
+    cli_args = arg_parser.parse_args()
     cli = MongoCLI('~/.pymdbsh.conf')
-    cli.run_session()
+    if cli_args.show_plan:
+        cli.settings['show_plan'] = True
+    try:
+        if cli_args.command is not None:
+            cli.run_script([cli_args.command], parallel=cli_args.parallel)
+        elif cli_args.script == '-' or (cli_args.script is None and not sys.stdin.isatty()):
+            cli.run_script(sys.stdin, parallel=cli_args.parallel)
+        elif cli_args.script is not None:
+            with open(cli_args.script, encoding='utf-8') as script:
+                cli.run_script(script, parallel=cli_args.parallel)
+        else:
+            cli.run_session()
+    except KeyboardInterrupt:
+        # Ctrl-C in -c/-f/stdin runs: exit like a shell killed by SIGINT
+        sys.exit(130)
+    except BrokenPipeError:
+        # The reader went away (e.g. `-c ... | head`); silence the final flush
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    else:
+        # Scripts and cron jobs only see failed commands through the exit status
+        if cli.failed and not cli.interactive:
+            sys.exit(1)
+    finally:
+        cli.close()
 
     #Join  syntax
     #SELECT a.*, b.name FROM users a JOIN orders b ON a.user_id = b.user_id WHERE a.status = 'active'
-
-    #Bugs
-        # Join where clause is not translating into match stage properly at the moment 
-        
\ No newline at end of file